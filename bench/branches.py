@@ -0,0 +1,52 @@
+"""Branch cost on a loop-heavy program: branches resolved at assembly
+time versus finding the destination at run time by scanning the lines
+labelled with the branch's label.
+
+Usage: python -m bench.branches [iterations] [labelled lines]
+"""
+import sys
+import time
+
+from dull.runtime import *
+
+def loopProgram(iterations, lines):
+    """`lines` lines labelled "L", each a countdown loop of its own."""
+    code = []
+    labelMap = {"L": []}
+    for i in range(lines):
+        code.append((i_pushInteger, iterations))
+        labelMap["L"].append(len(code))
+        # 1 swap sub dup branchIfPositive(last L) pop
+        code += [(i_pushInteger, 1), (i_swap, None), (i_sub, None), (i_dup, None),
+                 (i_branchIfPositive, len(code)), (i_pop, None)]
+    return (code, labelMap)
+
+def scanningProgram(code, labelMap):
+    """The same program, with each branch looking up its destination by
+    a linear scan of the label's addresses when executed."""
+    addrs = labelMap["L"]
+    def i_scanningBranchIfPositive(state, arg):
+        if state.pop() > 0:
+            dest = None
+            for a in addrs:
+                if a < state.ip: dest = a
+            state.ip = dest
+    return [(i_scanningBranchIfPositive, None) if fun == i_branchIfPositive else (fun, arg)
+            for (fun, arg) in code]
+
+def main(args):
+    iterations = int(args[0]) if len(args) > 0 else 20000
+    lines = int(args[1]) if len(args) > 1 else 50
+    (code, labelMap) = loopProgram(iterations, lines)
+    branches = iterations * lines
+    bc = compileBytecode(code)
+    for (name, fun) in [("scan", lambda: run(scanningProgram(code, labelMap))),
+                        ("resolved", lambda: run(code)),
+                        ("bytecode", lambda: executeBytecode(bc))]:
+        t0 = time.perf_counter()
+        fun()
+        t = time.perf_counter() - t0
+        print("%-10s %8.3fs  %12.0f branches/s" % (name, t, branches / t))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,51 @@
+"""Execution engine throughput on straight-line stack and arithmetic code.
+
+Usage: python -m bench.engines [instructions]
+"""
+import random
+import sys
+import time
+
+from dull.runtime import *
+
+def generateCode(size, seed=1):
+    rnd = random.Random(seed)
+    code = [(i_pushInteger, 1), (i_pushInteger, 2)]
+    while len(code) < size:
+        code.append((i_pushInteger, rnd.randrange(1, 27)))
+        code.append(rnd.choice([(i_add, None), (i_sub, None), (i_swap, None),
+                                (i_dup, None), (i_add, None)]))
+        if code[-1][0] == i_dup:
+            code.append((i_pop, None))
+    return code
+
+def main(args):
+    size = int(args[0]) if args else 1000000
+    code = generateCode(size)
+    t0 = time.perf_counter()
+    bc = compileBytecode(code)
+    print("%-10s %8.3fs" % ("(encode)", time.perf_counter() - t0))
+    t0 = time.perf_counter()
+    program = compilePython(code)
+    print("%-10s %8.3fs" % ("(compile)", time.perf_counter() - t0))
+    t0 = time.perf_counter()
+    linked = EngineState()
+    table = linkClosures(code, linked)
+    print("%-10s %8.3fs" % ("(link)", time.perf_counter() - t0))
+    def runLinked():
+        (linked.ip, linked.stack[:]) = (0, [])
+        executeClosures(table, linked)
+    for (name, engine) in [("tuple", lambda: run(code)),
+                           ("bytecode", lambda: executeBytecode(bc)),
+                           ("python", lambda: runCompiled(program)),
+                           ("closure", runLinked)]:
+        t = None
+        for i in range(3):
+            t0 = time.perf_counter()
+            engine()
+            dt = time.perf_counter() - t0
+            t = dt if t is None else min(t, dt)
+        print("%-10s %8.3fs  %12.0f instructions/s" % (name, t, len(code) / t))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
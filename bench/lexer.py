@@ -0,0 +1,44 @@
+"""Lexer throughput: table-driven tokenize() versus pattern trial.
+
+Usage: python -m bench.lexer [megabytes]
+"""
+import random
+import sys
+import time
+
+from dull.lexer import REFERENCE_TEXT, tokenize, tokenizeByPatterns
+
+def generateSource(size, seed=1):
+    """A program of roughly `size` characters: a mutated reference text
+    followed by repetitions of it with inserted integers."""
+    rnd = random.Random(seed)
+    ref = REFERENCE_TEXT.lower()
+    lines = ["All Work aand no pkay maeks Jack a dull boy!"]
+    total = len(lines[0])
+    while total < size:
+        # Letters other than those of the reference insert at word starts:
+        line = " ".join(rnd.choice("fghiqvxz") * (rnd.random() < 0.5) + word
+                        for word in ref.split(" "))
+        lines.append(line)
+        total += len(line) + 1
+    return "\n".join(lines) + "\n"
+
+def measure(fun, src, repeat=3):
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        fun(src)
+        t = time.perf_counter() - t0
+        best = t if best is None else min(best, t)
+    return best
+
+def main(args):
+    mb = float(args[0]) if args else 1.0
+    src = generateSource(int(mb * 1e6))
+    assert tokenize(src) == tokenizeByPatterns(src)
+    for (name, fun) in [("pattern trial", tokenizeByPatterns), ("table-driven", tokenize)]:
+        t = measure(fun, src)
+        print("%-14s %8.3fs  %10.0f chars/s" % (name, t, len(src) / t))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
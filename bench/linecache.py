@@ -0,0 +1,49 @@
+"""Line cache: tokenize() with and without a LineCache, on sources made
+of a few distinct lines repeated many times, and on unique lines.
+
+Usage: python -m bench.linecache [lines] [distinct lines]
+"""
+import random
+import sys
+import time
+
+from dull.lexer import LineCache, tokenize
+
+def repetitiveSource(lines, distinct, seed=1):
+    """A program whose lines past the first are drawn from `distinct`
+    different repetitions of the reference, inserting pushes and ending
+    in outputs (or are all different, if `distinct` is None)."""
+    rnd = random.Random(seed)
+    words = "all work and no play makes jack a dull boy".split(" ")
+    def randomLine():
+        return " ".join(rnd.choice("fghiqvxz") * (rnd.random() < 0.5) + word
+                        for word in words) + rnd.choice(["", "!"])
+    pool = [randomLine() for i in range(distinct or 0)]
+    body = [rnd.choice(pool) if pool else randomLine() for i in range(lines)]
+    return "All work and no play makes Jack a dull boy\n" + "\n".join(body) + "\n"
+
+def measure(fun):
+    best = None
+    for i in range(3):
+        t0 = time.perf_counter()
+        fun()
+        t = time.perf_counter() - t0
+        best = t if best is None else min(best, t)
+    return best
+
+def main(args):
+    lines = int(args[0]) if len(args) > 0 else 100000
+    distinct = int(args[1]) if len(args) > 1 else 100
+    for (name, src) in [("%d distinct" % distinct, repetitiveSource(lines, distinct)),
+                        ("all distinct", repetitiveSource(lines, None))]:
+        cache = LineCache()
+        assert tokenize(src, cache) == tokenize(src)
+        cache.clear()
+        plain = measure(lambda: tokenize(src))
+        cached = measure(lambda: tokenize(src, cache))
+        info = cache.info()
+        print("%-14s uncached %7.3fs  cached %7.3fs  (%d hits, %d misses)" %
+              (name, plain, cached, info.hits, info.misses))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,162 @@
+"""Benchmark suite: times tokenize(), tokensToCode() and running the code
+separately on each workload of bench.workloads, reporting throughput and
+peak memory. Results can be saved as JSON, and compared against earlier
+results; the exit status is 1 if any phase got slower by more than the
+threshold.
+
+Usage: python -m bench.suite [options] [workload...]
+"""
+import argparse
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from dull.lexer import tokenize
+from dull.assembler import tokensToCode
+from dull.runtime import ENGINES, EngineState, runFor
+
+from bench.workloads import WORKLOADS
+
+PHASES = ["tokenize", "tokensToCode", "run"]
+# Timings shorter than this are noise, and not compared:
+MIN_COMPARED_SECONDS = 0.005
+
+class OutputQuotaReached(Exception): pass
+
+class QuotaOutput:
+    """Binary output stream which stops the program once it has written
+    `quota` bytes; loop workloads run until then."""
+    def __init__(self, quota):
+        self.quota = quota
+        self.written = 0
+    def write(self, data):
+        self.written += len(data)
+        if self.quota != None and self.written >= self.quota:
+            raise OutputQuotaReached()
+    def flush(self): pass
+
+def runWorkload(engine, code, quota):
+    state = EngineState(out=QuotaOutput(quota), inp=io.BytesIO())
+    try:
+        engine(code, state)
+    except OutputQuotaReached:
+        pass
+
+def countInstructions(code, quota):
+    """The number of instructions executed by runWorkload()."""
+    state = EngineState(out=QuotaOutput(quota), inp=io.BytesIO())
+    try:
+        runFor(code, state)
+    except OutputQuotaReached:
+        pass
+    return state.executed
+
+def bestTime(fun, repeat):
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        fun()
+        t = time.perf_counter() - t0
+        best = t if best == None else min(best, t)
+    return best
+
+def peakMemory(fun):
+    """Peak memory allocated by fun(), in bytes. Measured in a run of its
+    own, as tracing slows allocation down."""
+    tracemalloc.start()
+    try:
+        fun()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def measureWorkload(name, scale, engine, repeat):
+    (generate, size, loops) = WORKLOADS[name]
+    size = max(1, int(size * scale))
+    src = generate(size)
+    tokens = tokenize(src)
+    code = tokensToCode(tokens)
+    quota = size if loops else None
+    phases = [("tokenize", lambda: tokenize(src), len(src), "chars"),
+              ("tokensToCode", lambda: tokensToCode(tokens), len(tokens), "tokens"),
+              ("run", lambda: runWorkload(engine, code, quota),
+               countInstructions(code, quota), "instructions")]
+    results = dict()
+    for (phase, fun, amount, unit) in phases:
+        seconds = bestTime(fun, repeat)
+        results[phase] = {"seconds": seconds,
+                          "throughput": amount / seconds if seconds > 0 else None,
+                          "unit": unit + "/s",
+                          "peakBytes": peakMemory(fun)}
+    return results
+
+def compare(results, baseline, threshold):
+    """Print the change of each phase's time against `baseline`, and
+    return the list of phases which regressed by more than `threshold`."""
+    for setting in ["python", "engine", "scale"]:
+        if results[setting] != baseline.get(setting):
+            print("Warning: %s differs from the baseline's (%s vs %s)" %
+                  (setting, results[setting], baseline.get(setting)))
+    regressions = []
+    for (name, phases) in sorted(results["workloads"].items()):
+        for phase in PHASES:
+            old = baseline["workloads"].get(name, {}).get(phase)
+            if old == None or phase not in phases: continue
+            seconds = phases[phase]["seconds"]
+            if max(seconds, old["seconds"]) < MIN_COMPARED_SECONDS: continue
+            ratio = seconds / old["seconds"]
+            flag = ""
+            if ratio > 1 + threshold:
+                regressions.append("%s/%s" % (name, phase))
+                flag = "  REGRESSION"
+            print("%-12s %-13s %8.3fs -> %8.3fs  %+6.1f%%%s" %
+                  (name, phase, old["seconds"], seconds, (ratio - 1) * 100, flag))
+    return regressions
+
+def main(args):
+    parser = argparse.ArgumentParser(prog="python -m bench.suite")
+    parser.add_argument("workloads", nargs="*",
+                        help="workloads to run, of: %s (default: all)" % (", ".join(WORKLOADS),))
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiply every workload's size by this factor")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="tuple",
+                        help="execution engine for the run phase (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="report the best of this many timings")
+    parser.add_argument("--save", metavar="PATH", help="write the results as JSON")
+    parser.add_argument("--compare", metavar="PATH",
+                        help="compare against results saved earlier")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slowdown counted as a regression (default: %(default)s)")
+    args = parser.parse_args(args)
+    for name in args.workloads:
+        if name not in WORKLOADS: parser.error("unknown workload: %s" % (name,))
+
+    results = {"python": platform.python_version(),
+               "engine": args.engine,
+               "scale": args.scale,
+               "workloads": dict()}
+    for name in args.workloads or list(WORKLOADS):
+        phases = measureWorkload(name, args.scale, ENGINES[args.engine], args.repeat)
+        results["workloads"][name] = phases
+        for phase in PHASES:
+            r = phases[phase]
+            print("%-12s %-13s %8.3fs  %12.0f %-15s %8.1f MB peak" %
+                  (name, phase, r["seconds"], r["throughput"] or 0, r["unit"], r["peakBytes"] / 1e6))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("Regressions: %s" % (", ".join(regressions),))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
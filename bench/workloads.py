@@ -0,0 +1,185 @@
+"""Synthetic Dull sources for the benchmark suite.
+
+A source is written by encoding a list of instructions as mutations of
+the reference text: the first line (labelled "All") holds the mutations
+which depend on reference letters, and each following line is another
+repetition of the reference, with letters (pushInteger) inserted at the
+starts of words and end punctuation after "boy". Every encoding is
+checked by assembling it, so a generated source always means what it was
+asked to.
+
+The only line a branch can name is the first one, so a loop is the
+whole program, jumping back to the start with ','. Loop workloads are
+written to output one character per iteration and are run until they
+have produced their quota of output (see bench.suite).
+"""
+import functools
+
+from dull.lexer import REFERENCE_TEXT, tokenize
+from dull.assembler import QWERTY_NEIGHBOURS, VOWELS, assemble
+from dull.runtime import *
+
+REFERENCE = "All" + REFERENCE_TEXT[3:]
+LABEL_LENGTH = len("All")
+PUNCTUATION_INSTRUCTIONS = {i_output: "!", i_input: "?"}
+# Where a letter may be inserted in a repetition: at the starts of words.
+REPETITION = REFERENCE_TEXT.lower()
+WORD_STARTS = [0] + [i + 1 for i in range(len(REPETITION)) if REPETITION[i] == " "]
+
+#==== Encoding: ========================================================
+def mutations(ins, arg, pos):
+    """The ways of encoding (ins, arg) at reference position `pos`, as
+    (source text, reference characters consumed) pairs."""
+    ref = REFERENCE.lower()
+    r0 = ref[pos]
+    r1 = ref[pos+1] if pos+1 < len(ref) else " "
+    if ins == i_pushInteger and 1 <= arg <= 26:
+        return [(chr(ord("a") + arg - 1), 0)]
+    if ins == i_pushMarker:
+        return [(" ", 0)]
+    if ins == i_createArray:
+        return [("", 1)] if r0 == " " else []
+    if not r0.isalpha():
+        return []
+    if ins == i_dup:
+        return [(r0 + r0, 1)]
+    if ins == i_pop or ins == i_swap:
+        return [("", 1)] if (ins == i_swap) == (r0 in VOWELS) else []
+    if ins in (i_add, i_sub, i_mul, i_div) and r1.isalpha():
+        kind = {(False, True): i_add, (True, False): i_sub,
+                (False, False): i_mul, (True, True): i_div}[(r0 in VOWELS, r1 in VOWELS)]
+        return [(r1 + r0, 2)] if kind == ins else []
+    return [(repl, 1) for ((org, repl), fun) in QWERTY_NEIGHBOURS.items()
+            if org == r0 and fun == ins]
+
+def assembled(src):
+    (code, labelMap) = assemble(tokenize(src))
+    return code
+
+def encodeFirstLine(instructions):
+    """Encode `instructions` as mutations of the reference text, greedily:
+    each one at the first position from which it assembles as intended."""
+    (text, pos) = (REFERENCE[:LABEL_LENGTH], LABEL_LENGTH)
+    for k in range(len(instructions)):
+        expected = instructions[:k+1]
+        while True:
+            if pos >= len(REFERENCE):
+                raise ValueError("Instructions do not fit in one line: %r" % (instructions,))
+            found = None
+            for (mut, adv) in mutations(instructions[k][0], instructions[k][1], pos):
+                candidate = text + mut + REFERENCE[pos+adv:]
+                try:
+                    if assembled(candidate) == expected:
+                        found = (mut, adv)
+                        break
+                except Exception:
+                    pass
+            if found != None:
+                text += found[0]
+                pos += found[1]
+                break
+            text += REFERENCE[pos]
+            pos += 1
+    return text + REFERENCE[pos:]
+
+@functools.lru_cache(maxsize=None)
+def repetitionCode(line):
+    """The code of a repetition line, following the reference text."""
+    return assembled(REFERENCE + "\n" + line + "\n")
+
+def endPunctuation(ins, arg):
+    if ins in PUNCTUATION_INSTRUCTIONS: return PUNCTUATION_INSTRUCTIONS[ins]
+    if ins == i_branchIfPositive and arg == 0: return ","
+    if ins == i_branch and arg == 0: return ";"
+    return None
+
+def encodeRepetition(instructions, k):
+    """Encode instructions from the k-th on as one repetition of the
+    reference, greedily: each push at the first word start at which it
+    assembles as intended. Returns (line, next instruction)."""
+    (text, pos, start) = ("", 0, k)
+    for slot in WORD_STARTS:
+        if k == len(instructions) or instructions[k][0] != i_pushInteger: break
+        arg = instructions[k][1]
+        if not 1 <= arg <= 26:
+            raise ValueError("Cannot encode in a repetition: %r" % (instructions[k],))
+        letter = chr(ord("a") + arg - 1)
+        probe = REPETITION[:slot] + letter + REPETITION[slot:]
+        if repetitionCode(probe) == [(i_pushInteger, arg)]:
+            (text, pos, k) = (text + REPETITION[pos:slot] + letter, slot, k + 1)
+    text += REPETITION[pos:]
+    if k < len(instructions) and endPunctuation(*instructions[k]) != None:
+        text += endPunctuation(*instructions[k])
+        k += 1
+    if k == start:
+        raise ValueError("Cannot encode in a repetition: %r" % (instructions[k],))
+    if repetitionCode(text) != list(instructions[start:k]):
+        raise ValueError("Repetition does not assemble as intended: %r" % (text,))
+    return (text, k)
+
+def encodeTail(instructions):
+    """Encode instructions after the first line, as repetitions of the
+    reference text."""
+    (lines, k) = ([], 0)
+    while k < len(instructions):
+        (line, k) = encodeRepetition(instructions, k)
+        lines.append(line)
+    return "".join(line + "\n" for line in lines)
+
+def encode(firstLine, tail):
+    return encodeFirstLine(firstLine) + "\n" + encodeTail(tail)
+
+#==== Workloads: =======================================================
+def push(*letters): return [(i_pushInteger, ord(c) - ord("a") + 1) for c in letters]
+def ins(*funs): return [(f, None) for f in funs]
+
+# Loop epilogue: output one character, then branch back to the start.
+LOOP_TAIL = push("j") + ins(i_output) + push("a") + [(i_branchIfPositive, 0)]
+
+def longProgram(size):
+    """Straight-line code of about `size` source characters: pushes, with
+    every eighth value output."""
+    tail = []
+    total = 0
+    n = 0
+    while total < size:
+        n += 1
+        c = chr(ord("a") + n % 26)
+        tail += push(c) + (ins(i_output) if n % 8 == 0 else [])
+        total += 6     # A repetition holds about eight pushes in 50 characters.
+    return encode([], tail)
+
+def largeOutput(size):
+    """Straight-line code outputting `size` characters, one at a time."""
+    tail = []
+    for n in range(size):
+        tail += push(chr(ord("a") + n % 26)) + ins(i_output)
+    return encode([], tail)
+
+def deepLoop(size):
+    """The smallest loop: one output and one branch per iteration."""
+    return encode([], LOOP_TAIL)
+
+def arithmeticLoop(size):
+    """A loop whose body is mostly stack arithmetic on large products."""
+    body = (push("z") + ins(i_dup, i_mul) + push("y") + ins(i_mul) +
+            push("x") + ins(i_dup, i_add, i_sub) + push("w") + ins(i_mul, i_pop))
+    return encode(body, LOOP_TAIL)
+
+def arrayLoop(size):
+    """A loop which grows an array to 26*26 elements and copies a range
+    of 25*25 elements within it."""
+    body = (ins(i_pushMarker, i_createArray, i_dup) + push("z") + ins(i_dup, i_mul, i_arrayResize) +
+            ins(i_dup) + push("a") + ins(i_swap) + push("b", "y") + ins(i_dup, i_mul, i_arrayRangeCopy))
+    return encode(body, LOOP_TAIL)
+
+# name: (generator, default size, whether the program loops). The size of
+# a loop workload is its number of iterations, and does not affect the
+# source.
+WORKLOADS = {
+    "long": (longProgram, 1000000, False),
+    "output": (largeOutput, 200000, False),
+    "loop": (deepLoop, 200000, True),
+    "arithmetic": (arithmeticLoop, 50000, True),
+    "arrays": (arrayLoop, 20000, True),
+}
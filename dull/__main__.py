@@ -1,17 +1,121 @@
-from dull.lexer import tokenize
-from dull.assembler import tokensToCode
-from dull.runtime import run
+from dull.lexer import MappedSource, iterNumberedTokens, numberedTokensParallel
+from dull.assembler import assembleWithLines
+from dull.runtime import ENGINES, Bytecode, EngineState, PreallocatedStack, compileBytecode
+from dull.optimizer import optimize
+from dull.verifier import verify
+from dull.cache import CodeCache, loadOrAssemble
+from dull.profiler import DebugInfo, Profile, runProfiled
+from dull.tracer import DEFAULT_TRACE_ENTRIES, TraceBuffer, debugInfoFor, runTraced
 
+import argparse
+import os
 import sys
 
-if len(sys.argv) < 2:
+parser = argparse.ArgumentParser(prog="python -m dull")
+parser.add_argument("srcfile", nargs="?")
+parser.add_argument("--engine", choices=sorted(ENGINES), default="tuple",
+                    help="execution engine (default: %(default)s)")
+parser.add_argument("-O", "--optimize", action="store_true",
+                    help="run the peephole optimizer on the assembled code")
+parser.add_argument("--profile", action="store_true",
+                    help="profile the program and report to stderr (uses the tuple engine)")
+parser.add_argument("--profile-top", type=int, default=10, metavar="N",
+                    help="number of entries in each profile table")
+parser.add_argument("--profile-pstats", metavar="PATH",
+                    help="with --profile, also write the profile in pstats format")
+parser.add_argument("--profile-collapsed", metavar="PATH",
+                    help="with --profile, also write collapsed stacks for flame graphs")
+parser.add_argument("--no-verify", action="store_true",
+                    help="do not reject programs which always underflow the stack")
+parser.add_argument("--max-stack-depth", type=int, metavar="N",
+                    help="stop the program with an error beyond N stack values")
+parser.add_argument("--stack-stats", action="store_true",
+                    help="report the stack's high-water mark to stderr")
+parser.add_argument("--trace", metavar="PATH",
+                    help="trace the last instructions executed (uses the tuple engine), and write "
+                         "the trace to PATH when the program ends or fails; '-' writes it decoded "
+                         "to stderr (decode files with python -m dull.tracer)")
+parser.add_argument("--trace-size", type=int, default=DEFAULT_TRACE_ENTRIES, metavar="N",
+                    help="number of instructions kept in the trace (default: %(default)s)")
+parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                    help="lex in N processes (0: one per CPU)")
+parser.add_argument("--no-cache", action="store_true",
+                    help="do not read or write the compiled code cache")
+parser.add_argument("--clear-cache", action="store_true",
+                    help="remove all entries from the compiled code cache")
+args = parser.parse_args()
+if args.max_stack_depth != None and args.max_stack_depth < 0:
+    parser.error("--max-stack-depth must not be negative")
+
+if args.clear_cache:
+    CodeCache().clear()
+if args.srcfile == None:
+    if args.clear_cache: sys.exit(0)
     print("Usage: python -m dull <srcfile>")
     sys.exit(1)
 
-srcfile = sys.argv[1]
-with open(srcfile, "r") as f:
-    lines = f.readlines()
-    src = "".join(lines)
-    code = tokensToCode(tokenize(src))
-    #print("DEBUG code=%s" % (code,))
-    run(code)
+def assembleSource(f):
+    # The source is lexed from a mapping of the file, not read as text.
+    # Line numbers place the return address of each call.
+    with MappedSource(f.name) as source:
+        if args.jobs != 1:
+            tokens = numberedTokensParallel(source, args.jobs or None)
+        else:
+            tokens = iterNumberedTokens(source.lines())
+        (code, labelMap, lineMap) = assembleWithLines(tokens)
+        if args.optimize:
+            code = optimize(code, labelMap)
+    if args.engine == "bytecode":
+        # Encode once; the cache keeps the encoded arrays.
+        code = compileBytecode(code)
+    return code
+
+def profile():
+    # Profiling needs line numbers, so bypasses the code cache.
+    with open(args.srcfile, "r") as f:
+        (code, labelMap, lineMap) = assembleWithLines(iterNumberedTokens(f))
+    if args.optimize:
+        code = optimize(code, labelMap, lineMap)
+    debugInfo = DebugInfo(args.srcfile, labelMap, lineMap)
+    prof = Profile(code)
+    try:
+        runProfiled(code, prof)
+    finally:
+        sys.stderr.write(prof.report(debugInfo, args.profile_top))
+        if args.profile_pstats: prof.writePstats(args.profile_pstats, debugInfo)
+        if args.profile_collapsed: prof.writeCollapsed(args.profile_collapsed, debugInfo)
+
+if args.profile:
+    profile()
+    sys.exit(0)
+
+cache = None if args.no_cache else CodeCache()
+options = ["optimize"] if args.optimize else []
+if args.engine == "bytecode": options.append("bytecode")
+code = loadOrAssemble(args.srcfile, assembleSource, cache, options)
+#print("DEBUG code=%s" % (code,))
+if not args.no_verify:
+    verify(code.code if isinstance(code, Bytecode) else code)
+state = None
+if args.max_stack_depth != None or args.stack_stats:
+    state = EngineState(stack=PreallocatedStack(maxDepth=args.max_stack_depth))
+
+def writeTrace(trace):
+    if args.trace == "-":
+        sys.stderr.write(trace.report(debugInfoFor(args.srcfile, args.optimize)))
+    else:
+        with open(args.trace, "wb") as f:
+            trace.write(f, os.path.abspath(args.srcfile), args.optimize)
+
+try:
+    if args.trace:
+        trace = TraceBuffer(args.trace_size)
+        try:
+            runTraced(code.code if isinstance(code, Bytecode) else code, trace, state)
+        finally:
+            writeTrace(trace)
+    else:
+        ENGINES[args.engine](code, state)
+finally:
+    if args.stack_stats:
+        sys.stderr.write("Stack high-water mark: %d\n" % (state.stack.highWater,))
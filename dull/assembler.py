@@ -1,9 +1,15 @@
 from dull.lexer import *
 from dull.runtime import *
 
+from array import array
+
 # Code representation:
 # - Resolved: (ins, arg)
 # - Unresolved: (ins, tag, labelName, posInLabelMap)
+# - Unresolved call: (i_call, tag, labelName, posInLabelMap, skip), skip
+#   being the number of instructions between the call and its return
+#   address, the start of the following source line (None until known).
+#   Resolved, its argument is (address, skip, tail): see i_call.
 
 # Tag values for tagging unresolved labels
 LBL_UNIQUE = {}
@@ -11,12 +17,44 @@ LBL_BEFORE = {}
 LBL_AFTER = {}
 
 PUNCTUATION = ".,:;!?"
-VOWELS = "aeiouy"
+
+# Replaced letters: the instruction depends on which QWERTY neighbour of
+# the original letter replaces it. Each row is offset half a key to the
+# right of the one above.
+QWERTY_ROWS = ["qwertyuiop", "asdfghjkl", "zxcvbnm"]
+
+def buildNeighbourTable():
+    pos = dict()
+    for (row, keys) in enumerate(QWERTY_ROWS):
+        for (i, c) in enumerate(keys):
+            pos[(row, 2*i + row)] = c
+    table = dict()
+    for ((row, x), c) in pos.items():
+        for (dRow, dx, ins) in [(0, -2, i_arrayStore),      # Left
+                                (0, 2, i_arrayFetch),       # Right
+                                (-1, 1, i_arrayGetSize),    # Up-and-right
+                                (-1, -1, i_arrayResize),    # Up-and-left
+                                (1, -1, i_arrayRangeCopy),  # Down-and-left
+                                (1, 1, None)]:              # Down-and-right: unused
+            neighbour = pos.get((row + dRow, x + dx))
+            if neighbour != None:
+                table[(c, neighbour)] = ins
+    return table
+
+QWERTY_NEIGHBOURS = buildNeighbourTable()
 
 class SyntaxError(Exception):
-    def __init__(self, msg): Error.__init__(self, msg)
+    def __init__(self, msg): Exception.__init__(self, msg)
 
 def tokensToCode(tokens):
+    """Assemble tokens into code. `tokens` may be any iterable, e.g. the
+    generator returned by iterTokens(); it is consumed in a single pass."""
+    (code, labelMap) = assemble(tokens)
+    return code
+
+def assemble(tokens):
+    """Like tokensToCode(), but also return the label map: a dict from
+    each label to the addresses of the lines it labels."""
     #print("DEBUG tokensToCode: tokens=%s" % (tokens,))
     code = []
     labelMap = dict()
@@ -24,24 +62,49 @@ def tokensToCode(tokens):
     generateInstructions(tokens, code, labelMap)
     # Pass 2: resolve labels
     resolveLabels(code, labelMap)
-    return code
+    markTailCalls(code)
+    return (code, labelMap)
+
+def assembleWithLines(numberedTokens):
+    """Assemble (lineNo, token) pairs, as produced by iterNumberedTokens().
+    Returns (code, labelMap, lineMap), where lineMap gives the source line
+    of each instruction. Unlike assemble(), which must infer where lines
+    end, it finds the return address of each call exactly."""
+    code = []
+    labelMap = dict()
+    lineMap = array("i")
+    generateInstructions(numberedTokens, code, labelMap, lineMap)
+    resolveLabels(code, labelMap)
+    markTailCalls(code)
+    return (code, labelMap, lineMap)
 
-def generateInstructions(tokens, code, labelMap):
+def generateInstructions(tokens, code, labelMap, lineMap=None):
     state = State(code, labelMap)
     visitor = Visitor(state)
-    for t in tokens:
-        t.visitWith(visitor)
+    if lineMap == None:
+        for t in tokens:
+            t.visitWith(visitor)
+    else:
+        state.lineMap = lineMap
+        visitor.linesKnown = True
+        for (state.curLine, t) in tokens:
+            t.visitWith(visitor)
+    visitor.finish()
 
 def isa(c, charClass):
     return charClass.find(c)>=0
 def isLetter(c):
-    return c>="a" and c<="z"
+    return CHARACTER_CLASSES.get(c, 0) & CONSONANT != 0
+def isVowel(c):
+    return CHARACTER_CLASSES.get(c, 0) == VOWEL
 
 class State:
     def __init__(self, code, labelMap):
         self.code = code
         self.labelMap = labelMap
         self.curLabel = None
+        self.lineMap = None # Source line of each instruction, if tracked
+        self.curLine = 0
 
     def registerLabel(self, label):
         addrs = self.labelMap.get(label)
@@ -53,11 +116,45 @@ class State:
 class Visitor:
     def __init__(self, state):
         self.state = state
+        self.pendingDots = 0 # Full stops at end of line, not yet assembled
+        # Calls whose source line has not ended yet, by address:
+        self.openCalls = []
+        # Does state.curLine number the lines? If not, a line is taken to
+        # end after the insertions following the end of the reference
+        # text, which holds unless a line goes on after an ellipsis.
+        self.linesKnown = False
+        self.atLineEnd = False  # Assembling the end of the reference text?
+        self.callsLine = 0  # The source line of the open calls
 
     def appendInstruction(self, ins):
+        if self.pendingDots > 0: self.flushDots()
+        if self.openCalls and not self.onCallsLine(): self.endLine()
         self.state.code.append(ins)
+        if self.state.lineMap != None: self.state.lineMap.append(self.state.curLine)
+
+    def onCallsLine(self):
+        if self.linesKnown: return self.state.curLine == self.callsLine
+        return self.atLineEnd
+
+    def endLine(self):
+        """Resolve the return addresses of the open calls to the next
+        instruction."""
+        code = self.state.code
+        for ip in self.openCalls:
+            code[ip] = code[ip][:4] + (len(code) - ip - 1,)
+        self.openCalls = []
+
+    def appendBranch(self, ins, tag):
+        label = self.state.curLabel
+        pos = len(self.state.labelMap.get(label, ()))
+        self.appendInstruction((ins, tag, label, pos))
+
+    def finish(self):
+        if self.pendingDots > 0: self.flushDots()
+        self.endLine()
 
     def handleLabel(self, label):
+        if self.pendingDots > 0: self.flushDots()
         self.state.curLabel = label
         if label != "": self.state.registerLabel(label)
 
@@ -67,48 +164,87 @@ class Visitor:
         elif c == " ":
             self.appendInstruction((i_pushMarker, None))
         elif isa(c, PUNCTUATION):
-            if atEnd:
+            if atEnd and c == ".":
+                if self.pendingDots == 0: self.dotsLine = self.state.curLine
+                self.pendingDots += 1 # May be part of an ellipsis.
+            elif atEnd:
+                self.atLineEnd = True
                 self.handlePunctuationEnd(c)
+                self.atLineEnd = False
             else:
                 pass # No operation; serves as part of the labelling mechanism.
         elif c == "'":
             self.appendInstruction((i_printDebugDump, None))
         else:
-            raise Error("Unexpected insertion: '%s' is not recognized" % (c,))
+            raise SyntaxError("Unexpected insertion: '%s' is not recognized" % (c,))
 
     def handlePunctuationEnd(self, c):
         if c == "?":
-            ins = (i_input, None)
+            self.appendInstruction((i_input, None))
         elif c == "!":
-            ins = (i_output, None)
+            self.appendInstruction((i_output, None))
+        elif c == ",":
+            self.appendBranch(i_branchIfPositive, LBL_BEFORE)
+        elif c == ":":
+            self.appendBranch(i_branch, LBL_AFTER)
+        elif c == ";":
+            self.appendBranch(i_branch, LBL_BEFORE)
         else:
-            raise Error("Unexpected insertion: '%s' is not recognized" % (c,))
-        self.appendInstruction(ins)
+            raise SyntaxError("Unexpected insertion: '%s' is not recognized" % (c,))
+
+    def flushDots(self):
+        # An ellipsis is a call or return; remaining full stops are
+        # conditional forward branches.
+        (ellipses, stops) = divmod(self.pendingDots, 3)
+        self.pendingDots = 0
+        # Full stops end a repetition of the reference text, and so, as
+        # far as can be told without line numbers, a line.
+        if not self.linesKnown: self.endLine()
+        (curLine, self.state.curLine) = (self.state.curLine, self.dotsLine)
+        (atLineEnd, self.atLineEnd) = (self.atLineEnd, True)
+        for i in range(ellipses):
+            if self.state.curLabel == "" or self.state.curLabel == None:
+                self.appendInstruction((i_return, None))
+            else:
+                self.appendBranch(i_call, LBL_UNIQUE)
+                self.state.code[-1] += (None,)
+                self.openCalls.append(len(self.state.code) - 1)
+                self.callsLine = self.dotsLine
+        for i in range(stops):
+            self.appendBranch(i_branchIfPositive, LBL_AFTER)
+        self.atLineEnd = atLineEnd
+        self.state.curLine = curLine
 
     def handleDeletion(self, c):
         if isLetter(c):
-            if isa(c, VOWELS):
+            if isVowel(c):
                 self.appendInstruction((i_swap, None))
             else:
                 self.appendInstruction((i_pop, None))
         elif c==" ": 
             self.appendInstruction((i_createArray, None))
         else:  
-            raise Error("Unexpected deletion: '%s' is not recognized" % (c,))
+            raise SyntaxError("Unexpected deletion: '%s' is not recognized" % (c,))
        
     def handleDoubling(self, c):
         if isLetter(c):
             self.appendInstruction((i_dup, None))
         else:  
-            raise Error("Unexpected deletion: '%s' is not recognized" % (c,))
+            raise SyntaxError("Unexpected doubling: '%s' is not recognized" % (c,))
+
+    def handleReplacement(self, org, repl):
+        ins = QWERTY_NEIGHBOURS.get((org, repl))
+        if ins == None:
+            raise SyntaxError("Unexpected replacement: '%s'->'%s' is not recognized" % (org, repl))
+        self.appendInstruction((ins, None))
 
     def handleTransposition(self, a, b):
         aLetter = isLetter(a)
         bLetter = isLetter(b)
         
         if aLetter and bLetter:
-            aVowel = isa(a, VOWELS)
-            bVowel = isa(b, VOWELS)
+            aVowel = isVowel(a)
+            bVowel = isVowel(b)
             if aVowel:
                 if bVowel:
                     ins = i_div
@@ -122,9 +258,45 @@ class Visitor:
             self.appendInstruction((ins, None))
         else:
             # TODO: Handle context access.
-            raise Error("Unexpected transposition: '%s%s'->'%s%s' is not recognized" % (a,b,b,a))
+            raise SyntaxError("Unexpected transposition: '%s%s'->'%s%s' is not recognized" % (a,b,b,a))
                 
 
 
 def resolveLabels(code, labelMap):
-    pass
+    """Replace each unresolved branch (ins, tag, label, posInLabelMap) by
+    (ins, address). posInLabelMap is the number of lines labelled with
+    `label` before the branch (including the branch's own line), so the
+    destinations are found by indexing the label's address list."""
+    for ip in range(len(code)):
+        ins = code[ip]
+        if len(ins) < 4: continue
+        (fun, tag, label, pos) = ins[:4]
+        addrs = labelMap.get(label, [])
+        if tag is LBL_AFTER:
+            if pos >= len(addrs):
+                raise SyntaxError("No following line labelled '%s'" % (label,))
+            addr = addrs[pos]
+        elif tag is LBL_BEFORE:
+            if pos == 0:
+                raise SyntaxError("No preceding line labelled '%s'" % (label,))
+            addr = addrs[pos - 1]
+        else: # LBL_UNIQUE
+            if len(addrs) != 1:
+                raise SyntaxError("Expected exactly one line labelled '%s', found %d" % (label, len(addrs)))
+            addr = addrs[0]
+        if fun is i_call:
+            code[ip] = (fun, (addr, ins[4], False))
+        else:
+            code[ip] = (fun, addr)
+
+def markTailCalls(code, start=0, end=None):
+    """Mark the resolved calls in code[start:end] which return to a return
+    as tail calls, and unmark the others."""
+    if end == None: end = len(code)
+    for ip in range(start, end):
+        (fun, arg) = code[ip]
+        if fun is not i_call: continue
+        ret = returnSite(ip, arg)
+        tail = ret < len(code) and code[ret][0] is i_return
+        if tail != arg[2]:
+            code[ip] = (fun, (arg[0], arg[1], tail))
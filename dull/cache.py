@@ -0,0 +1,179 @@
+"""On-disk cache of assembled code, keyed by source content.
+
+Entries live in a cache directory (like __pycache__, but shared between
+all programs) as one marshal file per source hash. A key covers the
+source text, the interpreter version and any assembly options, so stale
+entries are never loaded; they are simply evicted, least recently used
+first, once the cache grows beyond its size limit.
+"""
+from array import array
+import hashlib
+import marshal
+import os
+import sys
+
+import dull.runtime
+from dull.runtime import Bytecode
+
+CACHE_FORMAT = 2
+CACHE_SUFFIX = ".dullc"
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Modules whose source determines the assembled code:
+CODE_MODULES = ["lexer", "assembler", "optimizer", "runtime", "cache"]
+
+def defaultCacheDir():
+    d = os.environ.get("DULL_CACHE_DIR")
+    if d: return d
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "dull")
+
+_interpreterVersion = None
+def interpreterVersion():
+    """A digest identifying this interpreter: the sources of the modules
+    which produce code, plus the cache and marshal formats."""
+    global _interpreterVersion
+    if _interpreterVersion == None:
+        _interpreterVersion = computeInterpreterVersion(os.path.dirname(os.path.abspath(__file__)))
+    return _interpreterVersion
+
+def computeInterpreterVersion(pkgDir):
+    h = hashlib.sha256()
+    h.update(("%d:%d:%s:" % (CACHE_FORMAT, marshal.version, sys.byteorder)).encode("ascii"))
+    for name in CODE_MODULES:
+        with open(os.path.join(pkgDir, name + ".py"), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def sourceKey(chunks, options=()):
+    """Cache key for the source given as an iterable of byte strings,
+    assembled with `options`."""
+    h = hashlib.sha256()
+    h.update(interpreterVersion().encode("ascii"))
+    h.update(repr(tuple(options)).encode("utf-8"))
+    h.update(b"\0")
+    for chunk in chunks:
+        h.update(chunk)
+    return h.hexdigest()
+
+#==== Serialization: ==================================================
+# Instructions are stored by name; arguments must be marshallable.
+# Bytecode is stored as its code list plus the raw opcode/operand arrays,
+# so that loading it does not re-encode.
+def serializeCode(code):
+    if isinstance(code, Bytecode):
+        encoded = (code.ops.tobytes(), code.operands.tobytes())
+        code = code.code
+    else:
+        encoded = None
+    return marshal.dumps(([(ins[0].__name__,) + tuple(ins[1:]) for ins in code], encoded))
+
+def deserializeCode(data):
+    (instructions, encoded) = marshal.loads(data)
+    funs = {}
+    for name in set(ins[0] for ins in instructions):
+        if not name.startswith("i_"):
+            raise ValueError("Not an instruction: %r" % (name,))
+        funs[name] = getattr(dull.runtime, name)
+    code = [(funs[ins[0]],) + tuple(ins[1:]) for ins in instructions]
+    if encoded == None:
+        return code
+    (ops, operands) = (array("i"), array("q"))
+    ops.frombytes(encoded[0])
+    operands.frombytes(encoded[1])
+    if len(ops) != len(code) or len(operands) != len(code):
+        raise ValueError("Inconsistent bytecode")
+    return Bytecode(code, ops, operands)
+
+#==== The cache proper: ===============================================
+class CodeCache:
+    def __init__(self, directory=None, maxBytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or defaultCacheDir()
+        self.maxBytes = maxBytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+    def load(self, key):
+        """Return the cached code for `key`, or None."""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                code = deserializeCode(f.read())
+        except OSError:
+            return None
+        except (ValueError, EOFError, TypeError, AttributeError):
+            # Corrupt or foreign entry.
+            self.remove(path)
+            return None
+        try:
+            os.utime(path)  # Mark as recently used.
+        except OSError:
+            pass
+        return code
+
+    def store(self, key, code):
+        data = serializeCode(code)
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        tmpPath = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmpPath, "wb") as f:
+            f.write(data)
+        os.replace(tmpPath, path)
+        self.evict()
+
+    def entries(self):
+        """(mtime, size, path) of all entries, least recently used first."""
+        result = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return result
+        for name in names:
+            if not name.endswith(CACHE_SUFFIX): continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            result.append((st.st_mtime, st.st_size, path))
+        result.sort()
+        return result
+
+    def evict(self):
+        """Remove least recently used entries until within maxBytes."""
+        entries = self.entries()
+        total = sum(size for (mtime, size, path) in entries)
+        for (mtime, size, path) in entries:
+            if total <= self.maxBytes: break
+            self.remove(path)
+            total -= size
+
+    def clear(self):
+        for (mtime, size, path) in self.entries():
+            self.remove(path)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def loadOrAssemble(srcfile, assemble, cache, options=()):
+    """Return the code for `srcfile`, from `cache` if possible. On a miss,
+    `assemble(f)` is called with the opened source file and its result is
+    stored. `cache` may be None to bypass caching."""
+    if cache == None:
+        with open(srcfile, "r") as f:
+            return assemble(f)
+    with open(srcfile, "rb") as f:
+        key = sourceKey(iter(lambda: f.read(1 << 16), b""), options)
+    code = cache.load(key)
+    if code == None:
+        with open(srcfile, "r") as f:
+            code = assemble(f)
+        try:
+            cache.store(key, code)
+        except OSError:
+            pass  # Caching is best effort.
+    return code
@@ -0,0 +1,171 @@
+"""Incremental lexing and assembly, for tools which re-assemble a source
+after every edit.
+
+An IncrementalProgram keeps, for each source line, its tokens and the
+lexer and assembler states after it. An edit re-lexes the changed lines,
+and then the following lines until the states after a line agree with
+those before the edit; from there on, the old results stand. The code
+list is patched in place, so the work is proportional to the size of the
+edit, unless the edit moves a labelled line's address: then the code is
+re-assembled from the kept tokens (but not re-lexed).
+"""
+from bisect import bisect_left
+from array import array
+
+from dull.lexer import LexerState, lexerStateFrom, lexLine
+from dull.assembler import State, Visitor, markTailCalls, resolveLabels
+
+INITIAL_ASSEMBLER_STATE = (None, 0)     # (curLabel, pendingDots)
+
+class RecordingState(State):
+    """Assembler state which records label registrations, as
+    (label, line, address) triples."""
+    def __init__(self, code, labelMap):
+        State.__init__(self, code, labelMap)
+        self.registrations = []
+
+    def registerLabel(self, label):
+        self.registrations.append((label, self.curLine, len(self.code)))
+        State.registerLabel(self, label)
+
+def visitLine(tokens, visitor, lineNo):
+    """Assemble one line's tokens; returns the number of instructions."""
+    state = visitor.state
+    state.curLine = lineNo
+    before = len(state.code)
+    visitor.linesKnown = True
+    for t in tokens:
+        t.visitWith(visitor)
+    visitor.endLine()
+    return len(state.code) - before
+
+class IncrementalProgram:
+    def __init__(self, src=""):
+        self.lines = []
+        self.lineTokens = []
+        self.lexAfter = []      # Lexer state snapshot after each line
+        self.asmAfter = []      # Assembler state after each line
+        self.codeLengths = array("i")   # Number of instructions per line
+        self.labelLines = dict()    # Label -> the lines registering it
+        self.tailLength = 0     # Instructions assembled after the last line
+        self.code = []
+        self.labelMap = dict()
+        self.relexedLines = 0   # Lines lexed by the last update
+        self.replaceLines(0, 0, src.splitlines(True))
+
+    def setSource(self, src):
+        """Update to a new version of the whole source, re-lexing from the
+        first to the last line which differ."""
+        (old, new) = (self.lines, src.splitlines(True))
+        start = 0
+        while start < min(len(old), len(new)) and old[start] == new[start]:
+            start += 1
+        common = 0
+        while (common < min(len(old), len(new)) - start and
+               old[len(old) - 1 - common] == new[len(new) - 1 - common]):
+            common += 1
+        return self.replaceLines(start, len(old) - common, new[start:len(new) - common])
+
+    def stateBefore(self, line):
+        if line == 0: return (LexerState().snapshot(), INITIAL_ASSEMBLER_STATE)
+        return (self.lexAfter[line - 1], self.asmAfter[line - 1])
+
+    def replaceLines(self, start, end, newLines):
+        """Replace lines [start; end[ (numbered from 0) by `newLines`, each
+        with its line terminator. Returns (code, labelMap); on a syntax
+        error, the program is left unchanged."""
+        lines = list(newLines)
+        (lexSnapshot, (curLabel, pendingDots)) = self.stateBefore(start)
+        lexState = lexerStateFrom(lexSnapshot)
+        # Branches refer to labelled lines by their number among those
+        # with the same label, counted from the start of the program:
+        counts = dict((label, [None] * bisect_left(ls, start))
+                      for (label, ls) in self.labelLines.items())
+        state = RecordingState([], counts)
+        state.curLabel = curLabel
+        visitor = Visitor(state)
+        # Pending full stops come from an earlier line:
+        (visitor.pendingDots, visitor.dotsLine) = (pendingDots, start - 1)
+
+        (tokens, lexAfter, asmAfter, codeLengths) = ([], [], [], array("i"))
+        stop = end      # Old lines [start; stop[ are replaced by `lines`
+        while True:
+            k = len(tokens)
+            if k == len(lines):
+                # Continue with the old lines until back in step with them.
+                current = (lexState.snapshot(), (state.curLabel, visitor.pendingDots))
+                if stop == len(self.lines) or current == self.stateBefore(stop): break
+                lines.append(self.lines[stop])
+                stop += 1
+            lexState.tokens = []
+            lexLine(lines[k], lexState)
+            codeLengths.append(visitLine(lexState.tokens, visitor, start + k))
+            tokens.append(lexState.tokens)
+            lexAfter.append(lexState.snapshot())
+            asmAfter.append((state.curLabel, visitor.pendingDots))
+        self.relexedLines = len(lines)
+        regionCode = state.code
+        atEnd = stop == len(self.lines)
+        if atEnd:
+            state.code = tailCode = []
+            visitor.finish()
+
+        codeStart = sum(self.codeLengths[:start])
+        codeEnd = codeStart + sum(self.codeLengths[start:stop])
+        oldRegistrations = sorted((label, line - start, self.labelMap[label][i] - codeStart)
+                                  for (label, ls) in self.labelLines.items()
+                                  for (i, line) in enumerate(ls) if start <= line < stop)
+        newRegistrations = sorted((label, line - start, addr)
+                                  for (label, line, addr) in state.registrations)
+        delta = len(regionCode) - (codeEnd - codeStart)
+        labelsAfter = any(ls[-1] >= stop for ls in self.labelLines.values())
+        if oldRegistrations == newRegistrations and (delta == 0 or not labelsAfter):
+            # Labelled lines keep their addresses: only the new
+            # instructions need resolving.
+            resolveLabels(regionCode, self.labelMap)
+            if atEnd: resolveLabels(tailCode, self.labelMap)
+            lineDelta = len(lines) - (stop - start)
+            for ls in self.labelLines.values():
+                for i in range(bisect_left(ls, stop), len(ls)):
+                    ls[i] += lineDelta
+            if atEnd:
+                self.code[len(self.code) - self.tailLength:] = tailCode
+                self.tailLength = len(tailCode)
+            self.code[codeStart:codeEnd] = regionCode
+            self.codeLengths[start:stop] = codeLengths
+            self.asmAfter[start:stop] = asmAfter
+            # Calls may now return to a different instruction: those of
+            # the region, and those of the last line before it.
+            line = start - 1
+            while line >= 0 and self.codeLengths[line] == 0: line -= 1
+            first = codeStart - (self.codeLengths[line] if line >= 0 else 0)
+            markTailCalls(self.code, first,
+                          len(self.code) if atEnd else codeStart + len(regionCode))
+        else:
+            lineTokens = self.lineTokens[:start] + tokens + self.lineTokens[stop:]
+            (self.code, self.labelMap, self.labelLines, self.asmAfter,
+             self.codeLengths, self.tailLength) = assembleLines(lineTokens)
+        self.lines[start:stop] = lines
+        self.lineTokens[start:stop] = tokens
+        self.lexAfter[start:stop] = lexAfter
+        return (self.code, self.labelMap)
+
+def assembleLines(lineTokens):
+    """Assemble a program from the tokens of each of its lines. Returns
+    (code, labelMap, labelLines, asmAfter, codeLengths, tailLength)."""
+    (code, labelMap) = ([], dict())
+    state = RecordingState(code, labelMap)
+    visitor = Visitor(state)
+    asmAfter = []
+    codeLengths = array("i")
+    for (lineNo, tokens) in enumerate(lineTokens):
+        codeLengths.append(visitLine(tokens, visitor, lineNo))
+        asmAfter.append((state.curLabel, visitor.pendingDots))
+    before = len(code)
+    visitor.finish()
+    resolveLabels(code, labelMap)
+    markTailCalls(code)
+    labelLines = dict()
+    for (label, line, addr) in state.registrations:
+        labelLines.setdefault(label, []).append(line)
+    return (code, labelMap, labelLines, asmAfter, codeLengths, len(code) - before)
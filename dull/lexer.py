@@ -1,65 +1,105 @@
+import functools
+import mmap
+import os
 import re
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 
 REFERENCE_TEXT = "all work and no play makes jack a dull boy"
+# The reference text is repeated as many times as needed, each repetition
+# ending with a line break - lexed, like line breaks in the source, as a
+# space. Reference positions are taken modulo REFERENCE_PERIOD.
+REFERENCE_CYCLE = REFERENCE_TEXT + " "
+REFERENCE_PERIOD = len(REFERENCE_CYCLE)
+END_OF_REFERENCE = len(REFERENCE_TEXT)  # The position of the line break
+
+# Character classes of the letters, shared with the assembler:
+VOWELS = "aeiouy"
+CONSONANT = 1
+VOWEL = 3       # Vowels are letters too: VOWEL & CONSONANT is the letter bit.
+CHARACTER_CLASSES = dict((c, VOWEL if c in VOWELS else CONSONANT)
+                         for c in "abcdefghijklmnopqrstuvwxyz")
 
 #==== Tokens: ========================================================
+# Tokens are immutable and slotted; the lexer shares one instance between
+# all equal tokens (see internToken()), so a token stream is essentially
+# an array of references to a small set of objects.
 class Token:
+    __slots__ = ()
+    def args(self):
+        return tuple(getattr(self, f) for f in self.__slots__)
     def __eq__(self, other):
-        return (isinstance(other, self.__class__)
-            and self.__dict__ == other.__dict__)
+        return (self is other or
+                (isinstance(other, self.__class__) and self.args() == other.args()))
     def __ne__(self, other): return not self.__eq__(other)
     def __repr__(self):
-        clsName = "%s" % (self.__class__,)
-        clsName = clsName.split(".")[-1]
-        return "%s(%s)" % (clsName, self.args)
+        return "%s(%s)" % (self.__class__.__name__, list(self.args()))
     def __hash__(self):
-        return hash(self.__repr__)
+        return hash((self.__class__, self.args()))
 
 class LabelToken(Token):
+    __slots__ = ("label",)
     def __init__(self, label):
         self.label = label
-        self.args = [label]
     def visitWith(self, visitor): visitor.handleLabel(self.label)
 
 class DoublingToken(Token):
+    __slots__ = ("character",)
     def __init__(self, c):
         self.character = c
-        self.args = [c]
     def visitWith(self, visitor): visitor.handleDoubling(self.character)
 
 class InsertionToken(Token):
+    __slots__ = ("character", "atEnd")
     def __init__(self, c, atEnd = False):
         self.character = c
         self.atEnd = atEnd
-        self.args = [c, atEnd]
     def visitWith(self, visitor): visitor.handleInsertion(self.character, self.atEnd)
 
 class DeletionToken(Token):
+    __slots__ = ("character",)
     def __init__(self, c):
         self.character = c
-        self.args = [c]
     def visitWith(self, visitor): visitor.handleDeletion(self.character)
 
 class ReplacementToken(Token):
+    __slots__ = ("original", "replacement")
     def __init__(self, org, repl):
         self.original = org
         self.replacement = repl
-        self.args = [org,repl]
-    def visitWith(self, visitor): visitor.handleReplacement(self.org, self.replacement)
+    def visitWith(self, visitor): visitor.handleReplacement(self.original, self.replacement)
 
 class TranspositionToken(Token):
+    __slots__ = ("original1", "original2")
     def __init__(self, org1, org2):
         self.original1 = org1
         self.original2 = org2
-        self.args = [org1,org2]
     def visitWith(self, visitor): visitor.handleTransposition(self.original1, self.original2)
 
+INTERNED_TOKENS = dict()
+
+def internToken(cls, *args):
+    """Return the shared instance of the token cls(*args)."""
+    key = (cls,) + args
+    token = INTERNED_TOKENS.get(key)
+    if token == None:
+        token = cls(*args)
+        INTERNED_TOKENS[key] = token
+    return token
+
+# Lookahead past the end of a line sees LOOKAHEAD_PAD, which matches no
+# reference character: what follows the line break is not known.
+LOOKAHEAD_PAD = "\0"
+
 #==== Lexer entry point: ==============================================
 def normalizeChar(c):
     if c=='\n': return ' '
     return c
 
-def tokenize(src):
+def tokenizeByPatterns(src):
+    """Tokenize by trying each mutation pattern in turn, character by
+    character. This is a direct transcription of the decoding algorithm;
+    tokenize() produces the same token stream, only faster."""
     state = LexerState()
     lineNo = 0
     for line in src.splitlines(True):
@@ -71,14 +111,44 @@ def tokenize(src):
         while i<len(line):
             c  = normalizeChar(line[i])
             c2 = normalizeChar(line[i+1]) if i<len(line)-1 else ' '
-            c3 = normalizeChar(line[i+2]) if i<len(line)-2 else ' '
+            c3 = normalizeChar(line[i+2]) if i<len(line)-2 else (' ' if i<len(line)-1 else LOOKAHEAD_PAD)
             delta_i = handleCharacter(c, c2, c3, state, lineNo)
             i += delta_i
-        # Process end-of-line:
-        handleCharacter(" ", " ", " ", state, lineNo)
+        # Process end-of-line, unless consumed as lookahead:
+        if i == len(line): handleCharacter(" ", LOOKAHEAD_PAD, LOOKAHEAD_PAD, state, lineNo)
+
+    return state.tokens
 
+def tokenize(src, cache=None):
+    """Tokenize a source. If a LineCache is given, lines are lexed through
+    it."""
+    lex = cache.lexLine if cache != None else lexLine
+    state = LexerState()
+    for line in src.splitlines(True):
+        lex(line, state)
     return state.tokens
 
+def iterTokens(lines, cache=None):
+    """Yield the tokens of a source given as an iterable of lines, such as
+    an open file. Only one line is held in memory at a time."""
+    for (lineNo, t) in iterNumberedTokens(lines, cache):
+        yield t
+
+def iterNumberedTokens(lines, cache=None):
+    """Like iterTokens(), but yield (lineNo, token) pairs; lines are
+    numbered from 1."""
+    lex = cache.lexLine if cache != None else lexLine
+    state = LexerState()
+    lineNo = 0
+    for chunk in lines:
+        for line in chunk.splitlines(True):
+            lineNo += 1
+            lex(line, state)
+            if state.tokens:
+                for t in state.tokens:
+                    yield (lineNo, t)
+                state.tokens = []
+
 #==== Source pre-processing (normalization): ==========================
 
 def normalizeLine(line):
@@ -182,6 +252,136 @@ def identifyMutation(state, c, c2, c3):
     #     print("DEBUG: token=%s at '%s%s' (ref: '%s%s')" % (token, c,c2,refChar,refChar2))
     return (token, advSrc)
 
+#==== Lexer proper - table-driven typo detector: ==================
+# The mutation patterns only ever compare the source window (c,c2,c3)
+# against the reference characters at offsets -1..2 from the reference
+# position. The outcome of the pattern trial is therefore determined by
+# which of those comparisons hold, and can be tabulated once: the
+# comparisons are packed into a bitmask which indexes MUTATION_TABLE.
+
+# (srcIdx, refIdx) comparisons used by the mutation patterns, and their bits:
+WINDOW_BITS = {(0,1): 1, (0,-1): 2, (1,0): 4, (1,1): 8, (1,2): 16, (2,1): 32, (2,2): 64}
+
+# Token kinds, in the order identifyMutation() tries them:
+MUT_TRANSPOSITION = 1
+MUT_DELETION = 2
+MUT_DOUBLING = 3
+MUT_INSERTION = 4
+MUT_REPLACEMENT = 5
+
+MUTATION_PATTERNS = [
+    (TRANSPOSITION_PATTERN_SYNCED, MUT_TRANSPOSITION),
+    (DELETION_PATTERN_SYNCED, MUT_DELETION),
+    (DOUBLING_PATTERN_SYNCED, MUT_DOUBLING),
+    (INSERTION_PATTERN_SYNCED, MUT_INSERTION),
+    (REPLACEMENT_PATTERN, MUT_REPLACEMENT),
+    (TRANSPOSITION_PATTERN, MUT_TRANSPOSITION),
+    (DELETION_PATTERN, MUT_DELETION),
+    (DOUBLING_PATTERN, MUT_DOUBLING),
+    (INSERTION_PATTERN, MUT_INSERTION)]
+
+def buildMutationTable():
+    table = []
+    for mask in range(128):
+        entry = None
+        for ((pattern, advSrc, advRef), kind) in MUTATION_PATTERNS:
+            if all(mask & WINDOW_BITS[cmp] for cmp in pattern):
+                entry = (kind, advSrc, advRef)
+                break
+        table.append(entry)
+    return table
+
+MUTATION_TABLE = buildMutationTable()
+
+# For each reference position, the reference characters at offsets -1..2
+# from it, wrapping around the repetitions:
+def buildReferenceWindows():
+    def ref(pos): return REFERENCE_CYCLE[pos % REFERENCE_PERIOD]
+    return [(ref(pos-1), ref(pos), ref(pos+1), ref(pos+2))
+            for pos in range(REFERENCE_PERIOD)]
+
+REFERENCE_WINDOWS = buildReferenceWindows()
+REFERENCE_CHARS = REFERENCE_CYCLE
+END_PUNCTUATION = " .,:;!?'"
+
+def lexLine(line, state):
+    """Lex one source line, appending its tokens to state.tokens."""
+    line = normalizeLine(line)
+    if line=="": return
+
+    n = len(line)
+    low = line.lower()
+    # Pad for lookahead, and the end-of-line character at index n:
+    if len(low) != n:
+        # Some characters change length when lowercased; go char by char.
+        low = [normalizeChar(c).lower() for c in line] + [" ", LOOKAHEAD_PAD, LOOKAHEAD_PAD]
+        line = list(line) + [" "]
+    else:
+        low = low.replace("\n", " ") + " " + LOOKAHEAD_PAD * 2
+        line += " "
+
+    tokens = state.tokens
+    lb = state.labelBuilder
+    labelDone = lb.done
+    refPos = state.refPos
+    windows = REFERENCE_WINDOWS
+    refChars = REFERENCE_CHARS
+    table = MUTATION_TABLE
+    intern = internToken
+    (period, endOfReference) = (REFERENCE_PERIOD, END_OF_REFERENCE)
+
+    i = 0
+    while i <= n:
+        if refPos >= period: refPos -= period
+        c = low[i]
+        if c == refChars[refPos]:
+            # Unchanged character.
+            if not labelDone:
+                labelDone = lb.addCharacter(line[i], c)
+                if labelDone:
+                    tokens.append(LabelToken(lb.closeAndGetLabel()))
+            i += 1
+            refPos += 1
+            continue
+
+        (c2, c3) = (low[i+1], low[i+2])
+        (rm1, r0, r1, r2) = windows[refPos]
+        mask = ((c == r1) | (c == rm1) << 1 |
+                (c2 == r0) << 2 | (c2 == r1) << 3 | (c2 == r2) << 4 |
+                (c3 == r1) << 5 | (c3 == r2) << 6)
+        entry = table[mask]
+        if entry != None:
+            (kind, advSrc, advRef) = entry
+            if kind == MUT_INSERTION:
+                token = intern(InsertionToken, c, refPos == endOfReference)
+            elif kind == MUT_TRANSPOSITION:
+                token = intern(TranspositionToken, r0, r1)
+            elif kind == MUT_DELETION:
+                token = intern(DeletionToken, r0)
+            elif kind == MUT_DOUBLING:
+                token = intern(DoublingToken, c)
+            else:
+                token = intern(ReplacementToken, r0, c)
+        elif END_PUNCTUATION.find(c)>=0:
+            # Insertion of punctuation
+            token = intern(InsertionToken, c, refPos == endOfReference)
+            (advSrc, advRef) = (1, 0)
+        else:
+            raise Exception("Syntax error at '%s%s' (ref: '%s%s')" % (c,c2,r0,r1))
+
+        if not labelDone:
+            # Mutation found - time to close label.
+            lb.finalizeLabel()
+            tokens.append(LabelToken(lb.closeAndGetLabel()))
+            labelDone = True
+        tokens.append(token)
+        # A pattern may consume the end-of-line character as lookahead;
+        # it is then not processed again.
+        i += advSrc
+        refPos += advRef
+
+    state.refPos = refPos % period
+
 class LexerState:
     def __init__(self):
         self.refPos = 0         # Position in reference text
@@ -194,7 +394,7 @@ class LexerState:
         return self.src[self.lineStart:endPos]
 
     def isAtEnd(self):
-        return self.refPos >= len(REFERENCE_TEXT)
+        return self.refPos == END_OF_REFERENCE
 
     def resetLabel(self):
         self.labelBuilder = ""
@@ -206,11 +406,69 @@ class LexerState:
         self.tokens.append(token)
 
     def referenceChar(self, delta=0):
-        pos = self.refPos + delta
-        return REFERENCE_TEXT[pos] if pos>=0 and pos < len(REFERENCE_TEXT) else " "
+        return REFERENCE_WINDOWS[self.refPos][delta + 1]
 
     def advanceReference(self, delta=1):
-        self.refPos += delta
+        self.refPos = (self.refPos + delta) % REFERENCE_PERIOD
+
+    def snapshot(self):
+        """A hashable summary of the state which determines how the rest of
+        the source is lexed: the reference position and, until it is
+        complete, the label."""
+        pos = self.refPos
+        lb = self.labelBuilder
+        if lb.done: return pos
+        return (pos, lb.buffer, lb.lastUppercasePos, lb.lastSpacePos, lb.nextLastSpacePos)
+
+    def restore(self, snapshot):
+        """Return to the state summarised by `snapshot`; the tokens are
+        left as they are."""
+        lb = self.labelBuilder
+        if isinstance(snapshot, int):
+            self.refPos = snapshot
+            lb.done = True
+        else:
+            (self.refPos, lb.buffer, lb.lastUppercasePos, lb.lastSpacePos, lb.nextLastSpacePos) = snapshot
+            lb.done = False
+
+def lexerStateFrom(snapshot):
+    """The inverse of LexerState.snapshot(), with no tokens."""
+    state = LexerState()
+    state.restore(snapshot)
+    return state
+
+#==== Line cache: =====================================================
+# Machine-generated programs often repeat lines. A line's tokens depend
+# only on its text and the lexer state at its start, so a line which is
+# met again in the same state need not be lexed again.
+DEFAULT_LINE_CACHE_SIZE = 4096
+
+class LineCache:
+    """LRU cache of lexed lines, keyed on the normalised line and the
+    lexer state snapshot at its start."""
+    def __init__(self, capacity=DEFAULT_LINE_CACHE_SIZE):
+        self.lexFrom = functools.lru_cache(maxsize=capacity)(lexLineFrom)
+
+    def lexLine(self, line, state):
+        """Like lexLine()."""
+        line = normalizeLine(line)
+        if line == "": return
+        (tokens, after) = self.lexFrom(line, state.snapshot())
+        state.tokens.extend(tokens)
+        state.restore(after)
+
+    def info(self):
+        """Statistics, as (hits, misses, maxsize, currsize)."""
+        return self.lexFrom.cache_info()
+
+    def clear(self): self.lexFrom.cache_clear()
+
+def lexLineFrom(line, snapshot):
+    """Lex a line from the state given by `snapshot`. Returns the line's
+    tokens (as a tuple) and the snapshot of the state after it."""
+    state = lexerStateFrom(snapshot)
+    lexLine(line, state)
+    return (tuple(state.tokens), state.snapshot())
 
 class LabelBuilder:
     def __init__(self):
@@ -254,3 +512,194 @@ class LabelBuilder:
 
     def shouldTrim(self):
         return self.nextLastSpacePos >= self.lastUppercasePos
+
+#==== Parallel lexing: ================================================
+# Lines are not lexed independently: the reference position and the label
+# carry over from one line to the next (a reference text may be split
+# over several lines). A chunk of lines can therefore only be lexed on its
+# own from a guessed start state. The guess is LINE_START_STATE: the label
+# complete and the reference at the start of a repetition, which is where
+# a line starts in programs written one repetition of the reference per
+# line.
+#
+# Each chunk is lexed in a worker process from its guessed state, which
+# also records the state after each of its lines. When the results are
+# joined, in order, a chunk whose actual start state differs from the
+# guess is re-lexed line by line until its state agrees with the worker's
+# after the same line; the worker's tokens are used from there on. The
+# result is always that of the sequential lexer.
+LINE_START_STATE = 0
+PARALLEL_CHUNK_SIZE = 1 << 20   # Characters per chunk, rounded up to a line
+
+def tokenizeParallel(src, processes=None, chunkSize=PARALLEL_CHUNK_SIZE):
+    """Like tokenize(), but lexing chunks of the source in `processes`
+    worker processes (default: one per CPU). The source may be a string or
+    a MappedSource."""
+    result = []
+    for (tokens, lineEnds) in lexChunksParallel(src, processes, chunkSize):
+        result.extend(tokens)
+    return result
+
+def numberedTokensParallel(src, processes=None, chunkSize=PARALLEL_CHUNK_SIZE):
+    """Like tokenizeParallel(), but returning (lineNo, token) pairs as
+    iterNumberedTokens() does."""
+    result = []
+    lineNo = 0
+    for (tokens, lineEnds) in lexChunksParallel(src, processes, chunkSize):
+        start = 0
+        for end in lineEnds:
+            lineNo += 1
+            result.extend((lineNo, t) for t in tokens[start:end])
+            start = end
+    return result
+
+def splitChunks(src, chunkSize):
+    if isinstance(src, MappedSource): return src.spans(chunkSize)
+    chunks = []
+    start = 0
+    while start < len(src):
+        end = src.find("\n", start + chunkSize)
+        end = len(src) if end < 0 else end + 1
+        chunks.append(src[start:end])
+        start = end
+    return chunks
+
+def lexChunksParallel(src, processes, chunkSize):
+    """Yield (tokens, lineEnds) per chunk of the source, where lineEnds[i]
+    is the number of the chunk's tokens up to the end of its i'th line."""
+    if processes == None: processes = os.cpu_count() or 1
+    chunks = splitChunks(src, chunkSize)
+    if len(chunks) <= 1 or processes <= 1:
+        # Not worth a process pool.
+        if src: yield relexChunk(src, LexerState().snapshot(), None)[:2]
+        return
+    guesses = [LexerState().snapshot()] + [LINE_START_STATE] * (len(chunks) - 1)
+    with ProcessPoolExecutor(processes) as pool:
+        actual = guesses[0]
+        for (chunk, guess, result) in zip(chunks, guesses, pool.map(lexChunk, chunks, guesses)):
+            (table, indexes, lineEnds, after, complete) = result
+            table = [LabelToken(*args) if cls is LabelToken else internToken(cls, *args)
+                     for (cls, args) in table]
+            tokens = [table[i] for i in indexes]
+            if actual != guess or not complete:
+                # Wrong guess, or the worker met a syntax error (which may
+                # be real, or due to the guess): lex again, from the start
+                # state this chunk really has.
+                (tokens, lineEnds, after) = relexChunk(chunk, actual, (tokens, lineEnds, after))
+            yield (tokens, lineEnds)
+            actual = after[-1]
+
+def lexChunk(chunk, snapshot):
+    """Worker: lex a chunk of lines from the state given by `snapshot`.
+    Returns (tokenTable, tokenIndexes, lineEnds, stateAfterEachLine,
+    complete), the tokens as indexes into a table of (class, args) pairs;
+    if not complete, lexing stopped at a syntax error, and the results
+    cover the lines before it."""
+    state = lexerStateFrom(snapshot)
+    lineEnds = array("i")
+    after = []
+    complete = True
+    (tokens, snapshot) = (state.tokens, state.snapshot)
+    try:
+        for line in chunkLines(chunk):
+            lexLine(line, state)
+            lineEnds.append(len(tokens))
+            after.append(snapshot())
+    except Exception:
+        complete = False
+    del tokens[lineEnds[-1] if lineEnds else 0:]
+    unique = list({id(t): t for t in tokens}.values())
+    ids = {id(t): i for (i, t) in enumerate(unique)}
+    indexes = array("i", map(ids.__getitem__, map(id, tokens)))
+    table = [(t.__class__, t.args()) for t in unique]
+    return (table, indexes, lineEnds, after, complete)
+
+def relexChunk(chunk, snapshot, speculated):
+    """Lex a chunk of lines from the state given by `snapshot`, returning
+    (tokens, lineEnds, stateAfterEachLine). `speculated` may be such a
+    result for (some of) the chunk's first lines lexed from another state;
+    once the states agree after a line, it is used for the lines it covers."""
+    state = lexerStateFrom(snapshot)
+    tokens = state.tokens
+    lineEnds = array("i")
+    after = []
+    lines = list(chunkLines(chunk))
+    i = 0
+    while i < len(lines):
+        lexLine(lines[i], state)
+        lineEnds.append(len(tokens))
+        after.append(state.snapshot())
+        i += 1
+        if speculated != None and i < len(speculated[2]) and after[-1] == speculated[2][i - 1]:
+            # The states agree: adopt the speculated lines after this one.
+            (specTokens, specEnds, specAfter) = speculated
+            offset = len(tokens) - specEnds[i - 1]
+            tokens.extend(specTokens[specEnds[i - 1]:])
+            lineEnds.extend(end + offset for end in specEnds[i:])
+            after.extend(specAfter[i:])
+            i = len(specAfter)
+            state = lexerStateFrom(after[-1])
+            state.tokens = tokens
+            speculated = None
+    return (tokens, lineEnds, after)
+
+def chunkLines(chunk):
+    """The lines of a chunk: a string, a span of a file or a whole
+    MappedSource."""
+    if isinstance(chunk, str): return chunk.splitlines(True)
+    if isinstance(chunk, MappedSource): return chunk.lines()
+    return mappedLines(*chunk)
+
+def mappedLines(path, offset, length):
+    with MappedSource(path) as source:
+        yield from source.lines(offset, offset + length)
+
+#==== Memory-mapped sources: ==========================================
+# A MappedSource maps a source file into memory instead of reading it into
+# a string. Lines are decoded from the mapping one at a time, as they are
+# lexed, so the source is never held whole as text. For parallel lexing,
+# chunks are passed to the workers as (path, offset, length) spans of the
+# file, which they map themselves, rather than as text copied through a
+# pipe.
+MAPPED_BLOCK_SIZE = 1 << 16
+
+class MappedSource:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            # Empty files cannot be mapped.
+            if os.fstat(f.fileno()).st_size == 0:
+                self.data = b""
+            else:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap): self.data.close()
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+    def __len__(self): return len(self.data)
+
+    def lines(self, start=0, end=None):
+        """Yield the lines in the byte range [start; end[ (which must be on
+        line boundaries), decoded as UTF-8 and split as str.splitlines()
+        does. Lines are decoded a block of MAPPED_BLOCK_SIZE bytes at a
+        time; no encoded line break is part of a multi-byte character, so
+        blocks are cut after one on the bytes."""
+        data = self.data
+        if end == None: end = len(data)
+        while start < end:
+            stop = data.find(b"\n", min(start + MAPPED_BLOCK_SIZE, end), end)
+            stop = end if stop < 0 else stop + 1
+            yield from data[start:stop].decode("utf-8").splitlines(True)
+            start = stop
+
+    def spans(self, chunkSize):
+        """Split the file into (path, offset, length) spans of about
+        `chunkSize` bytes, each ending with a line."""
+        (data, spans, start) = (self.data, [], 0)
+        while start < len(data):
+            end = data.find(b"\n", start + chunkSize)
+            end = len(data) if end < 0 else end + 1
+            spans.append((self.path, start, end - start))
+            start = end
+        return spans
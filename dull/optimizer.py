@@ -0,0 +1,136 @@
+"""Peephole optimizer for assembled code.
+
+optimize() rewrites the code list produced by the assembler:
+
+- constant folding: pushInteger a, pushInteger b, add/sub/mul
+- dead code: dup, pop / pushInteger, pop / pushMarker, pop
+- swap cancellation: swap, swap; and pushInteger a, pushInteger b, swap
+- the superinstruction pushConstantArray for
+  pushMarker, pushInteger..., createArray
+
+Rewrites never span a branch target: an instruction that can be jumped to
+(a labelled address, a branch destination, or a return address) may only
+begin a rewritten sequence. Addresses in the label map and in branch
+instructions are remapped to the optimized code.
+
+Rewrites keep stack underflows: dup, pop and swap, swap are only removed
+where the stack analysis proves the stack deep enough for them on every
+path.
+"""
+from dull.runtime import *
+from dull.verifier import ADDRESS_INSTRUCTIONS, analyze, branchTargets
+
+# Arithmetic on the two topmost stack values, as the instructions compute it:
+FOLDABLE = {
+    i_add: lambda top, second: top + second,
+    i_sub: lambda top, second: top - second,
+    i_mul: lambda top, second: top * second,
+}
+
+DISCARDABLE = (i_pushInteger, i_pushMarker, i_pushConstantArray, i_dup)
+
+# Values an instruction needs on the stack, which removing it must not
+# hide an underflow of:
+NEEDED_DEPTHS = {i_dup: 1, i_swap: 2}
+
+def optimize(code, labelMap=None, lineMap=None):
+    """Return the optimized code. `labelMap` is updated in place, as is
+    `lineMap` (the source line of each instruction), if given."""
+    if labelMap == None: labelMap = dict()
+    targets = branchTargets(code, labelMap)
+    peephole = Peephole(analyze(code, labelMap).lowDepths)
+    addrMap = dict()    # Target address -> new address
+    for ip in range(len(code)):
+        if ip in targets:
+            addrMap[ip] = len(peephole.out)
+        peephole.append(code[ip], ip, ip in targets)
+    addrMap[len(code)] = len(peephole.out)
+    if lineMap != None:
+        lines = [lineMap[o] for o in peephole.origins]
+        del lineMap[:]
+        lineMap.extend(lines)
+
+    out = peephole.out
+    for i in range(len(out)):
+        (fun, arg) = out[i]
+        if fun == i_call:
+            # Calls are never rewritten, so keep their original address.
+            ret = addrMap[returnSite(peephole.origins[i], arg)]
+            out[i] = (fun, (addrMap[arg[0]], ret - i - 1, arg[2]))
+        elif fun in ADDRESS_INSTRUCTIONS:
+            out[i] = (fun, addrMap[arg])
+    for (label, addrs) in labelMap.items():
+        labelMap[label] = [addrMap[a] for a in addrs]
+    return out
+
+class Peephole:
+    def __init__(self, lowDepths):
+        self.lowDepths = lowDepths  # Least stack depth before each original address
+        self.out = []
+        self.fixed = []     # For each instruction in `out`: may it be a target?
+        self.origins = []   # For each instruction in `out`: the original address
+        self.pendingFixed = False # Is the next instruction a target?
+
+    def append(self, ins, origin, isTarget):
+        self.out.append(ins)
+        self.origins.append(origin)
+        self.fixed.append(isTarget or self.pendingFixed)
+        self.pendingFixed = False
+        while self.rewriteTail(): pass
+
+    def rewriteTail(self):
+        """Apply one rewrite to the end of the output, if possible. Only the
+        first instruction of a rewritten sequence may be a branch target;
+        its replacement takes over that role."""
+        out = self.out
+        fixed = self.fixed
+        n = len(out)
+        if n < 2 or fixed[-1]: return False
+        (fun, arg) = out[-1]
+        (prev, prevArg) = out[-2]
+
+        if fun == i_pop and prev in DISCARDABLE and self.deepEnough(n - 2):
+            self.replace(2, [])
+        elif fun == i_swap and prev == i_swap and self.deepEnough(n - 2):
+            self.replace(2, [])
+        elif fun == i_createArray:
+            # Find the start of: pushMarker, pushInteger..., createArray
+            i = n - 2
+            while i >= 0 and out[i][0] == i_pushInteger and not fixed[i]:
+                i -= 1
+            if i < 0 or out[i][0] != i_pushMarker: return False
+            items = tuple(v for (f, v) in out[i+1:n-1])
+            self.replace(n - i, [(i_pushConstantArray, items)])
+        elif n >= 3 and not fixed[-2] and prev == i_pushInteger and out[-3][0] == i_pushInteger:
+            second = out[-3][1]
+            if fun in FOLDABLE:
+                self.replace(3, [(i_pushInteger, FOLDABLE[fun](prevArg, second))])
+            elif fun == i_swap:
+                self.replace(3, [(i_pushInteger, prevArg), (i_pushInteger, second)])
+            else:
+                return False
+        else:
+            return False
+        return True
+
+    def deepEnough(self, i):
+        """Is the stack always deep enough for the output instruction at
+        `i` (an original instruction) not to underflow?"""
+        needed = NEEDED_DEPTHS.get(self.out[i][0], 0)
+        if needed == 0: return True
+        low = self.lowDepths[self.origins[i]]
+        return low != None and low >= needed
+
+    def replace(self, count, instructions):
+        start = len(self.out) - count
+        wasFixed = self.fixed[start]
+        origin = self.origins[start]
+        del self.out[start:]
+        del self.fixed[start:]
+        del self.origins[start:]
+        for ins in instructions:
+            self.out.append(ins)
+            self.fixed.append(wasFixed)
+            self.origins.append(origin)
+            wasFixed = False
+        self.pendingFixed = self.pendingFixed or wasFixed
@@ -0,0 +1,145 @@
+"""Instruction-level profiler.
+
+runProfiled() executes code like runtime.run(), but counts executions,
+jumps and time per instruction address and tracks the maximal stack
+depth. The plain engines are untouched, so profiling costs nothing
+unless it is used.
+
+A Profile is reported against DebugInfo, which maps addresses back to
+source lines (from the lexer's line numbers) and labels (from the
+assembler's label map).
+"""
+from bisect import bisect_right
+from time import perf_counter_ns
+import marshal
+
+from dull.runtime import *
+
+BRANCH_INSTRUCTIONS = (i_branch, i_branchIfPositive, i_call, i_return)
+
+class DebugInfo:
+    def __init__(self, srcfile, labelMap, lineMap):
+        self.srcfile = srcfile
+        self.lineMap = lineMap
+        # Labelled addresses in order, for finding the label of an address:
+        starts = sorted((addr, label) for (label, addrs) in labelMap.items() for addr in addrs)
+        self.labelStarts = [addr for (addr, label) in starts]
+        self.labels = [label for (addr, label) in starts]
+
+    def line(self, ip):
+        return self.lineMap[ip] if ip < len(self.lineMap) else 0
+
+    def label(self, ip):
+        i = bisect_right(self.labelStarts, ip)
+        return self.labels[i-1] if i > 0 else ""
+
+    def describe(self, ip):
+        return "%s:%d [%s] @%d" % (self.srcfile, self.line(ip), self.label(ip), ip)
+
+class Profile:
+    def __init__(self, code):
+        self.code = code
+        n = len(code)
+        self.counts = [0] * n   # Executions per address
+        self.jumps = [0] * n    # Executions which did not fall through
+        self.times = [0] * n    # Nanoseconds per address
+        self.maxDepth = 0
+
+    def opcodeTotals(self):
+        """{instruction name: (count, nanoseconds)}"""
+        totals = dict()
+        for ip in range(len(self.code)):
+            if self.counts[ip] == 0: continue
+            name = self.code[ip][0].__name__
+            (c, t) = totals.get(name, (0, 0))
+            totals[name] = (c + self.counts[ip], t + self.times[ip])
+        return totals
+
+    def lineTotals(self, debugInfo):
+        """{(line, label): (count, nanoseconds)}"""
+        totals = dict()
+        for ip in range(len(self.code)):
+            if self.counts[ip] == 0: continue
+            key = (debugInfo.line(ip), debugInfo.label(ip))
+            (c, t) = totals.get(key, (0, 0))
+            totals[key] = (c + self.counts[ip], t + self.times[ip])
+        return totals
+
+    def report(self, debugInfo, top=10):
+        out = []
+        total = sum(self.times) or 1
+        out.append("Instructions executed: %d, max stack depth: %d" % (sum(self.counts), self.maxDepth))
+        out.append("")
+        out.append("Hot lines:")
+        out.append("%8s %12s %10s %6s  %s" % ("line", "count", "ms", "%", "label"))
+        lines = sorted(self.lineTotals(debugInfo).items(), key=lambda e: -e[1][1])
+        for ((line, label), (c, t)) in lines[:top]:
+            out.append("%8d %12d %10.3f %6.2f  %s" % (line, c, t / 1e6, 100.0 * t / total, label))
+        out.append("")
+        out.append("Instructions:")
+        out.append("%-24s %12s %10s %6s" % ("instruction", "count", "ms", "%"))
+        for (name, (c, t)) in sorted(self.opcodeTotals().items(), key=lambda e: -e[1][1]):
+            out.append("%-24s %12d %10.3f %6.2f" % (name, c, t / 1e6, 100.0 * t / total))
+        branches = [ip for ip in range(len(self.code))
+                    if self.counts[ip] > 0 and self.code[ip][0] in BRANCH_INSTRUCTIONS]
+        if branches:
+            out.append("")
+            out.append("Branches:")
+            out.append("%-40s %-20s %12s %8s" % ("location", "instruction", "count", "taken"))
+            for ip in sorted(branches, key=lambda ip: -self.counts[ip])[:top]:
+                out.append("%-40s %-20s %12d %7.1f%%" % (
+                    debugInfo.describe(ip), self.code[ip][0].__name__, self.counts[ip],
+                    100.0 * self.jumps[ip] / self.counts[ip]))
+        return "\n".join(out) + "\n"
+
+    def pstats(self, debugInfo):
+        """The profile in the form of pstats.Stats data: each (source line,
+        instruction) is a function."""
+        stats = dict()
+        for ip in range(len(self.code)):
+            if self.counts[ip] == 0: continue
+            key = (debugInfo.srcfile, debugInfo.line(ip),
+                   "%s:%s" % (debugInfo.label(ip), self.code[ip][0].__name__))
+            (cc, nc, tt, ct, callers) = stats.get(key, (0, 0, 0.0, 0.0, {}))
+            (c, t) = (self.counts[ip], self.times[ip] / 1e9)
+            stats[key] = (cc + c, nc + c, tt + t, ct + t, callers)
+        return stats
+
+    def writePstats(self, path, debugInfo):
+        """Write a file loadable with pstats.Stats(path)."""
+        with open(path, "wb") as f:
+            marshal.dump(self.pstats(debugInfo), f)
+
+    def writeCollapsed(self, path, debugInfo):
+        """Write collapsed stacks (label;line;instruction microseconds),
+        the input format of flamegraph.pl and speedscope."""
+        with open(path, "w") as f:
+            for (key, (cc, nc, tt, ct, callers)) in sorted(self.pstats(debugInfo).items()):
+                (srcfile, line, name) = key
+                (label, ins) = name.rsplit(":", 1)
+                f.write("%s;line %d;%s %d\n" % (label or "-", line, ins, round(tt * 1e6)))
+
+def runProfiled(code, profile, state=None):
+    if state == None: state = EngineState()
+    counts = profile.counts
+    jumps = profile.jumps
+    times = profile.times
+    stack = state.stack
+    maxDepth = profile.maxDepth
+    clock = perf_counter_ns
+    try:
+        while True:
+            ip = state.ip
+            if ip >= len(code): break
+            state.ip = ip + 1
+            (fun,arg) = code[ip]
+            t0 = clock()
+            fun(state, arg)
+            times[ip] += clock() - t0
+            counts[ip] += 1
+            if state.ip != ip + 1: jumps[ip] += 1
+            if len(stack) > maxDepth: maxDepth = len(stack)
+    finally:
+        profile.maxDepth = maxDepth
+        state.flush()
+    return state
@@ -1,20 +1,174 @@
+from array import array
+import codecs
+import functools
+import gc
+import io
+import os
+import sys
+import time
+
 #==================== Engine ====================
-def run(code):
-    state = EngineState()
-    while True:
-        ip = state.ip
-        if ip >= len(code): break
-        state.ip = ip + 1
-        (fun,arg) = code[ip]
-        fun(state, arg)
+def run(code, state=None):
+    if state == None: state = EngineState()
+    try:
+        while True:
+            ip = state.ip
+            if ip >= len(code): break
+            state.ip = ip + 1
+            (fun,arg) = code[ip]
+            fun(state, arg)
+    finally:
+        state.flush()
+    return state
+
+# With a time budget, runFor() checks the clock after each slice of this
+# many instructions:
+TIME_SLICE = 1000
+
+def runFor(code, state=None, instructions=None, seconds=None):
+    """Run like run(), but stop after `instructions` instructions or once
+    `seconds` have elapsed, if given. Returns the state, which can be
+    passed to runFor() or run() again to continue; the program has ended
+    when state.ip >= len(code). state.executed counts the instructions
+    run. The clock is only read between slices of TIME_SLICE instructions,
+    and an input instruction may block beyond the time budget."""
+    if state == None: state = EngineState()
+    deadline = None if seconds == None else time.perf_counter() + seconds
+    remaining = instructions
+    try:
+        while state.ip < len(code) and (remaining == None or remaining > 0):
+            if deadline == None:
+                count = remaining if remaining != None else sys.maxsize
+            else:
+                count = TIME_SLICE if remaining == None else min(TIME_SLICE, remaining)
+            count = runSlice(code, state, count)
+            if remaining != None: remaining -= count
+            if deadline != None and time.perf_counter() >= deadline: break
+    finally:
+        state.flush()
+    return state
+
+def runSlice(code, state, count):
+    """Run at most `count` instructions; returns the number run."""
+    end = len(code)
+    n = 0
+    try:
+        while n < count:
+            ip = state.ip
+            if ip >= end: break
+            state.ip = ip + 1
+            n += 1
+            (fun,arg) = code[ip]
+            fun(state, arg)
+    finally:
+        state.executed += n
+    return n
+
+def binaryStream(stream):
+    """The binary side of a standard stream. A text-only replacement (such
+    as io.StringIO under redirect_stdout) is adapted; a missing one (None,
+    as under pythonw) reads as empty and discards writes."""
+    if stream == None: return io.BytesIO()
+    buffer = getattr(stream, "buffer", None)
+    if buffer != None: return buffer
+    return TextStreamAdapter(stream)
+
+class TextStreamAdapter:
+    """Byte-level access to a text stream, in UTF-8."""
+    def __init__(self, stream): self.stream = stream
+    def write(self, data): return self.stream.write(data.decode("utf-8", "surrogatepass"))
+    def flush(self): self.stream.flush()
+    # Character counts stand in for byte counts; the decoder buffers any excess.
+    def read(self, size=-1): return self.stream.read(size).encode("utf-8", "surrogatepass")
+    def readline(self): return self.stream.readline().encode("utf-8", "surrogatepass")
+
+class ExecutionError(Exception):
+    def __init__(self, msg): Exception.__init__(self, msg)
 
 class EngineState:
-    def __init__(self):
+    def __init__(self, out=None, inp=None, stack=None):
         self.ip = 0
-        self.gctx = []
-        self.lctx = []
-        self.stack = []
+        self.gctx = DullArray(array("q"))
+        self.lctx = DullArray(array("q"))
+        # A list, or any object with the same stack operations, such as a
+        # PreallocatedStack.
+        self.stack = [] if stack is None else stack
+        self.executed = 0   # Instructions run by runFor()
         self.ctxStack = []
+        # Binary output stream, written in bulk and flushed on termination,
+        # and binary input stream, decoded as UTF-8 on demand. Both default
+        # to the process's standard streams, looked up on first use.
+        self.outStream = out
+        self.inpStream = inp
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.inputBuffer = ""   # Decoded but not yet consumed input
+        self.returnAddresses = dict()   # Address -> its ReturnAddress
+
+    @property
+    def out(self):
+        if self.outStream == None: self.outStream = binaryStream(sys.stdout)
+        return self.outStream
+
+    @property
+    def inp(self):
+        if self.inpStream == None: self.inpStream = binaryStream(sys.stdin)
+        return self.inpStream
+
+    def flush(self):
+        if self.outStream != None: self.outStream.flush()
+
+    def returnAddress(self, addr):
+        r = self.returnAddresses.get(addr)
+        if r is None: r = self.returnAddresses[addr] = ReturnAddress(addr)
+        return r
+
+    def readInput(self, count):
+        """Read `count` characters, or less at end of input; if count is
+        zero, read a line; if negative, read at most -count characters
+        without blocking."""
+        if count > 0:
+            return self.takeInput(count, lambda need: self.inp.read(need))
+        elif count == 0:
+            newline = self.inputBuffer.find("\n")
+            if newline >= 0: return self.takeInput(newline + 1, None)
+            return self.takeInput(-1, lambda need: self.inp.readline())
+        else:
+            if len(self.inputBuffer) < -count:
+                data = self.readAvailable(-count - len(self.inputBuffer))
+                self.decodeInput(data, False)
+            return self.takeInput(-count, None)
+
+    def takeInput(self, count, read):
+        """Consume `count` characters (-1: one read's worth) from the input
+        buffer, refilling it with read(bytesNeeded) while that returns data."""
+        while read != None and (count < 0 or len(self.inputBuffer) < count):
+            data = read(count - len(self.inputBuffer))
+            self.decodeInput(data, not data)
+            if not data or count < 0: break
+        if count < 0: count = len(self.inputBuffer)
+        result = self.inputBuffer[:count]
+        self.inputBuffer = self.inputBuffer[count:]
+        return result
+
+    def decodeInput(self, data, final):
+        self.inputBuffer += self.decoder.decode(data, final)
+
+    def readAvailable(self, maxBytes):
+        inp = self.inp
+        try:
+            fd = inp.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            fd = None
+        read1 = getattr(inp, "read1", inp.read)
+        if fd == None: return read1(maxBytes)
+        wasBlocking = os.get_blocking(fd)
+        os.set_blocking(fd, False)
+        try:
+            return read1(maxBytes) or b""
+        except BlockingIOError:
+            return b""
+        finally:
+            os.set_blocking(fd, wasBlocking)
 
     def push(self, v): self.stack.append(v)
     def pop(self): return self.stack.pop()
@@ -22,7 +176,99 @@ class EngineState:
     def swap(self):
         st = self.stack
         (st[-1],st[-2]) = (st[-2],st[-1])
-    
+
+class PreallocatedStack:
+    """A stack in a preallocated buffer with an explicit stack pointer,
+    supporting the list operations the engines use (append, pop, and
+    indexing from the top). Pops and reads below the bottom raise
+    ExecutionError naming the depth needed; pushes beyond `maxDepth`
+    values, if given, raise ExecutionError too. `highWater` is the
+    greatest depth reached."""
+    __slots__ = ("items", "sp", "maxDepth", "highWater")
+    def __init__(self, values=(), capacity=256, maxDepth=None):
+        if maxDepth != None:
+            if maxDepth < 0: raise ValueError("Negative maximum stack depth: %d" % (maxDepth,))
+            capacity = min(capacity, maxDepth)
+        self.items = [None] * max(capacity, 1)
+        self.sp = 0
+        self.maxDepth = maxDepth
+        self.highWater = 0
+        self.extend(values)
+
+    def append(self, v):
+        sp = self.sp
+        if sp == self.maxDepth:
+            raise ExecutionError("Stack overflow: more than %d values" % (self.maxDepth,))
+        if sp == len(self.items): self.grow()
+        self.items[sp] = v
+        sp += 1
+        self.sp = sp
+        if sp > self.highWater: self.highWater = sp
+
+    def pop(self):
+        sp = self.sp - 1
+        if sp < 0: raise ExecutionError("Stack underflow: pop from an empty stack")
+        items = self.items
+        v = items[sp]
+        items[sp] = None    # Release the reference
+        self.sp = sp
+        return v
+
+    def grow(self):
+        n = len(self.items)
+        size = 2 * n if self.maxDepth == None else min(2 * n, self.maxDepth)
+        self.items.extend([None] * (size - n))
+
+    def position(self, i):
+        if isinstance(i, int):
+            p = self.sp + i if i < 0 else i
+            if 0 <= p < self.sp: return p
+            if i < 0:
+                raise ExecutionError("Stack underflow: %d values needed, %d on the stack" %
+                                     (-i, self.sp))
+        raise IndexError("stack index out of range: %r" % (i,))
+    def __getitem__(self, i): return self.items[self.position(i)]
+    def __setitem__(self, i, v): self.items[self.position(i)] = v
+
+    def extend(self, values):
+        for v in values: self.append(v)
+    def clear(self):
+        self.items[:self.sp] = [None] * self.sp
+        self.sp = 0
+    def __len__(self): return self.sp
+    def __iter__(self): return iter(self.items[:self.sp])
+    def __eq__(self, other):
+        if isinstance(other, PreallocatedStack): other = list(other)
+        return isinstance(other, list) and list(self) == other
+    __hash__ = None
+    def __repr__(self): return repr(list(self))
+
+class Marker:
+    def __repr__(self): return "<marker>"
+
+MARKER = Marker()
+
+class ReturnAddress:
+    __slots__ = ("addr",)
+    def __init__(self, addr): self.addr = addr
+    def __eq__(self, other):
+        return isinstance(other, ReturnAddress) and self.addr == other.addr
+    __hash__ = None
+    def __repr__(self): return "<return to %d>" % (self.addr,)
+
+# ReturnAddress objects are immutable and shared: each engine creates one
+# per call site of the program it runs, so calls allocate nothing.
+
+def returnSite(ip, arg):
+    """The address a call at `ip` with argument `arg` returns to."""
+    return ip + 1 + arg[1]
+
+def returnTarget(retaddr):
+    """The address a return to `retaddr` continues at."""
+    if retaddr.__class__ is not ReturnAddress:
+        raise ExecutionError("Return address expected: %r" % (retaddr,))
+    return retaddr.addr
+
 #==================== Instructions ====================
 
 #==================== Stack manipulation
@@ -31,7 +277,7 @@ def i_pop(state,arg): state.pop()
 def i_swap(state,arg): state.swap()
 def i_pushInteger(state,arg):
     state.push(arg)
-def i_pushMarker(state,arg): pass
+def i_pushMarker(state,arg): state.push(MARKER)
 
 #====================  Arithmetic
 def i_add(state,arg): state.push(state.pop() + state.pop())
@@ -40,34 +286,168 @@ def i_mul(state,arg): state.push(state.pop() * state.pop())
 def i_div(state,arg): pass
 
 #====================  I/O
-def i_input(state,arg): pass
+def i_input(state,arg):
+    count = state.pop()
+    if not isinstance(count, int):
+        raise ExecutionError("Input count must be an integer: %r" % (count,))
+    state.flush()
+    state.push(DullArray(array("q", map(ord, state.readInput(count)))))
 def i_output(state,arg):
     v = state.pop()
-    printIOList(v)
+    state.out.write(ioListToString(v).encode("utf-8", "surrogatepass"))
 def i_printDebugDump(state,arg):
-    print("/---- DUMP:")
-    print("Stack: %s" % (state.stack,))
-    print("\\----")
+    # To standard error, after the output written so far:
+    state.flush()
+    if sys.stderr == None: return
+    sys.stderr.write("/---- DUMP:\nAddress: %d\nStack: %s\n\\----\n" % (state.ip - 1, state.stack))
 
-def printIOList(v):
-    if type(v) == type(0):
-        print(chr(v))
-    else:
-        for x in v:
-            printIOList(x)
+def ioListToString(v):
+    """Flatten an I/O-list (an integer or an array of I/O-lists) into the
+    string of characters it represents."""
+    parts = []
+    pending = [v]   # Values still to be converted, last one first
+    try:
+        while pending:
+            x = pending.pop()
+            if isinstance(x, int):
+                parts.append(chr(x))
+            elif isinstance(x, DullArray):
+                try:
+                    parts.append("".join(map(chr, x.items)))
+                except TypeError:
+                    pending.extend(reversed(x.items)) # Not flat; descend.
+            else:
+                raise TypeError()
+    except (TypeError, ValueError, OverflowError):
+        raise ExecutionError("Not an I/O-list: %r" % (v,))
+    return "".join(parts)
     
 #====================  Flow control
-def i_branch(state,arg): pass
-def i_branchIfPositive(state,arg): pass
-def i_call(state,arg): pass
-def i_return(state,arg): pass
+def i_branch(state,arg): state.ip = arg
+def i_branchIfPositive(state,arg):
+    if state.pop() > 0: state.ip = arg
+def i_call(state,arg):
+    # (... arg) -> (... retaddr arg). The argument is (procedure, skip,
+    # tail): the call returns to the start of the following source line,
+    # `skip` instructions after the next one; a tail call is followed by a
+    # return, so it leaves the return address of its caller in place.
+    (target, skip, tail) = arg
+    if not tail:
+        v = state.pop()
+        state.push(state.returnAddress(state.ip + skip))
+        state.push(v)
+    state.ip = target
+def i_return(state,arg):
+    # (... retaddr value) -> (... value)
+    v = state.pop()
+    addr = returnTarget(state.pop())
+    state.push(v)
+    state.ip = addr
 
 #====================  Arrays
-def i_createArray(state,arg): pass
-def i_arrayFetch(state,arg): pass
-def i_arrayStore(state,arg): pass
-def i_arrayGetSize(state,arg): pass
-def i_arrayResize(state,arg): pass
+# Arrays are DullArray objects, which hold their elements either in a
+# compact array('q') (while all elements are 64-bit integers) or in a list.
+# Storing anything else in a typed array promotes it to a list in place,
+# so all references to the array see the change.
+class DullArray:
+    __slots__ = ("items",)
+    def __init__(self, items):
+        self.items = items
+    def __len__(self): return len(self.items)
+    def __iter__(self): return iter(self.items)
+    def __eq__(self, other):
+        return isinstance(other, DullArray) and list(self.items) == list(other.items)
+    __hash__ = None
+    def __repr__(self): return "DullArray(%r)" % (list(self.items),)
+
+    def promote(self):
+        if not isinstance(self.items, list):
+            self.items = list(self.items)
+
+def makeArray(values):
+    try:
+        return DullArray(array("q", values))
+    except (TypeError, OverflowError):
+        return DullArray(list(values))
+
+def popArray(state, what):
+    v = state.pop()
+    if not isinstance(v, DullArray):
+        raise ExecutionError("%s must be an array: %r" % (what, v))
+    return v
+
+def i_createArray(state,arg):
+    items = []
+    while True:
+        v = state.pop()
+        if v is MARKER: break
+        items.append(v)
+    items.reverse()
+    state.push(makeArray(items))
+def i_pushConstantArray(state,arg):
+    # Superinstruction for: pushMarker, pushInteger..., createArray
+    state.push(makeArray(arg))
+def i_arrayFetch(state,arg):
+    # (... array index) -> (... value)
+    index = state.pop()
+    a = popArray(state, "Array")
+    state.push(fetchItem(a, index))
+def i_arrayStore(state,arg):
+    # (... array index value) -> (...)
+    value = state.pop()
+    index = state.pop()
+    a = popArray(state, "Array")
+    fetchItem(a, index) # Check the index
+    try:
+        a.items[index] = value
+    except (TypeError, OverflowError):
+        a.promote()
+        a.items[index] = value
+def i_arrayGetSize(state,arg):
+    # (... array) -> (... size)
+    state.push(len(popArray(state, "Array").items))
+def i_arrayResize(state,arg):
+    # (... array size) -> (...)
+    size = state.pop()
+    a = popArray(state, "Array")
+    if not isinstance(size, int) or size < 0:
+        raise ExecutionError("Array size must be a non-negative integer: %r" % (size,))
+    items = a.items
+    n = len(items)
+    if size <= n:
+        del items[size:]
+    elif isinstance(items, list):
+        items.extend([0] * (size - n))
+    else:
+        items.frombytes(bytes(items.itemsize * (size - n)))
+def i_arrayRangeCopy(state,arg):
+    # (... src soff dest doff count) -> (...)
+    count = state.pop()
+    doff = state.pop()
+    dest = popArray(state, "Destination")
+    soff = state.pop()
+    src = popArray(state, "Source")
+    checkRange(count, min(len(src.items), len(dest.items)), "Count")
+    checkRange(doff, len(dest.items) - count, "Destination offset")
+    checkRange(soff, len(src.items) - count, "Source offset")
+    chunk = src.items[soff:soff+count]
+    if isinstance(chunk, list) and not isinstance(dest.items, list):
+        try:
+            chunk = array("q", chunk)
+        except (TypeError, OverflowError):
+            dest.promote()
+    dest.items[doff:doff+count] = chunk
+
+def fetchItem(a, index):
+    try:
+        if index >= 0: return a.items[index]
+    except (TypeError, IndexError):
+        pass
+    raise ExecutionError("Array index out of range [0; %d[: %r" % (len(a.items), index))
+
+def checkRange(v, maxValue, what):
+    if not isinstance(v, int) or v < 0 or v > maxValue:
+        raise ExecutionError("%s must be an integer in [0; %d]: %r" % (what, maxValue, v))
 
 #==================== Context access
 def i_pushLocalContext(state,arg): pass
@@ -75,3 +455,415 @@ def i_pushGlobalContext(state,arg): pass
 def i_enterScope(state,arg): pass
 def i_exitScope(state,arg): pass
 def i_(state,arg): pass
+
+#==================== Bytecode engine ====================
+# The bytecode engine runs code encoded as two parallel arrays of opcodes
+# and integer operands. The common stack, arithmetic and flow control
+# instructions are executed inline by the dispatch loop, with the stack
+# operations held in locals; every other instruction is encoded as OP_CALL and executed by
+# calling its instruction function, the operand being its address.
+OP_CALL = 0
+OP_PUSH = 1
+OP_POP = 2
+OP_DUP = 3
+OP_SWAP = 4
+OP_ADD = 5
+OP_SUB = 6
+OP_MUL = 7
+OP_BRANCH = 8
+OP_BRANCH_IF_POSITIVE = 9
+OP_CALL_PROCEDURE = 10
+OP_RETURN = 11
+
+INLINE_OPCODES = {
+    i_pushInteger: OP_PUSH,
+    i_pop: OP_POP,
+    i_dup: OP_DUP,
+    i_swap: OP_SWAP,
+    i_add: OP_ADD,
+    i_sub: OP_SUB,
+    i_mul: OP_MUL,
+    i_branch: OP_BRANCH,
+    i_branchIfPositive: OP_BRANCH_IF_POSITIVE,
+    i_call: OP_CALL_PROCEDURE,
+    i_return: OP_RETURN,
+}
+
+# Opcodes whose operand is the instruction argument rather than its address:
+ARGUMENT_OPCODES = (OP_PUSH, OP_BRANCH, OP_BRANCH_IF_POSITIVE, OP_CALL_PROCEDURE)
+
+# Instructions whose operand is their argument rather than their address:
+ARGUMENT_INSTRUCTIONS = frozenset(fun for (fun, op) in INLINE_OPCODES.items()
+                                  if op in ARGUMENT_OPCODES)
+
+class Bytecode:
+    def __init__(self, code, ops=None, operands=None):
+        self.code = code
+        # The return address pushed by each call:
+        self.returns = dict((ip, ReturnAddress(returnSite(ip, ins[1])))
+                            for (ip, ins) in enumerate(code) if ins[0] is i_call)
+        if ops != None:
+            # Previously encoded, e.g. loaded from the code cache.
+            (self.ops, self.operands) = (ops, operands)
+            return
+        opcode = INLINE_OPCODES.get
+        argumentIns = ARGUMENT_INSTRUCTIONS
+        self.ops = array("i", [opcode(ins[0], OP_CALL) for ins in code])
+        operands = [ins[1] if ins[0] in argumentIns else ip for (ip, ins) in enumerate(code)]
+        for ip in self.returns:
+            # A call's operand is its procedure; a tail call is a branch.
+            (operands[ip], skip, tail) = code[ip][1]
+            if tail: self.ops[ip] = OP_BRANCH
+        try:
+            self.operands = array("q", operands)
+        except OverflowError:
+            # Operands too big for the operand array are executed by call.
+            for ip in range(len(code)):
+                if not -2**63 <= operands[ip] < 2**63:
+                    self.ops[ip] = OP_CALL
+                    operands[ip] = ip
+            self.operands = array("q", operands)
+
+def compileBytecode(code):
+    return Bytecode(code)
+
+def runBytecode(code, state=None):
+    """Run a code list, or a Bytecode encoded in advance."""
+    bc = code if isinstance(code, Bytecode) else compileBytecode(code)
+    return executeBytecode(bc, state)
+
+def executeBytecode(bc, state=None):
+    if state == None: state = EngineState()
+    ops = bc.ops
+    operands = bc.operands
+    code = bc.code
+    returns = bc.returns
+    stack = state.stack
+    push = stack.append
+    pop = stack.pop
+    end = len(ops)
+    ip = state.ip
+    # Opcodes are spelled as literals: comparing against constants is
+    # cheaper than looking up the OP_* globals on every dispatch.
+    try:
+        while ip < end:
+            op = ops[ip]
+            if op == 1:   # OP_PUSH
+                push(operands[ip])
+            elif op == 5: # OP_ADD
+                push(pop() + pop())
+            elif op == 0: # OP_CALL
+                state.ip = ip + 1
+                (fun, arg) = code[ip]
+                fun(state, arg)
+                ip = state.ip
+                continue
+            elif op == 3: # OP_DUP
+                push(stack[-1])
+            elif op == 2: # OP_POP
+                pop()
+            elif op == 4: # OP_SWAP
+                (stack[-1], stack[-2]) = (stack[-2], stack[-1])
+            elif op == 9: # OP_BRANCH_IF_POSITIVE
+                if pop() > 0:
+                    ip = operands[ip]
+                    continue
+            elif op == 8: # OP_BRANCH
+                ip = operands[ip]
+                continue
+            elif op == 6: # OP_SUB
+                push(pop() - pop())
+            elif op == 10: # OP_CALL_PROCEDURE
+                push(stack[-1])
+                stack[-2] = returns[ip]
+                ip = operands[ip]
+                continue
+            elif op == 11: # OP_RETURN
+                ip = returnTarget(stack[-2])
+                stack[-1] = pop()
+                continue
+            else:         # OP_MUL
+                push(pop() * pop())
+            ip += 1
+    finally:
+        state.ip = ip
+        state.flush()
+    return state
+
+#==================== Python compiler engine ====================
+# The Python engine translates code into the source of a Python function,
+# in which each basic block is a run of inline stack operations, and
+# branches select the next block in a dispatch loop. Instructions without
+# an inline translation are called as functions. The compiled code object
+# depends only on the generated source, and is cached by it.
+INLINE_PYTHON = {
+    i_pop: "pop()",
+    i_dup: "push(stack[-1])",
+    i_swap: "(stack[-1], stack[-2]) = (stack[-2], stack[-1])",
+    i_add: "push(pop() + pop())",
+    i_sub: "push(pop() - pop())",
+    i_mul: "push(pop() * pop())",
+    i_pushMarker: "push(MARKER)",
+}
+
+class CompiledProgram:
+    def __init__(self, code):
+        self.code = code
+        (source, namespace) = pythonSource(code)
+        self.source = source
+        namespace["code"] = code
+        namespace["MARKER"] = MARKER
+        namespace["returnTarget"] = returnTarget
+        exec(compilePythonSource(source), namespace)
+        self.function = namespace["program"]
+
+@functools.lru_cache(maxsize=64)
+def compilePythonSource(source):
+    return compile(source, "<dull program>", "exec")
+
+def pythonSource(code):
+    """Generate the source of `program(state)`, running `code` from
+    state.ip. Returns (source, namespace), where the namespace binds the
+    called instructions and their non-literal arguments."""
+    end = len(code)
+    starts = {0}
+    for (ip, ins) in enumerate(code):
+        fun = ins[0]
+        if fun is i_branch or fun is i_branchIfPositive:
+            starts.add(ins[1])
+            starts.add(ip + 1)
+        elif fun is i_call:
+            starts.add(ins[1][0])
+            starts.add(ip + 1)
+            starts.add(returnSite(ip, ins[1]))
+        elif fun is i_return:
+            starts.add(ip + 1)
+    starts = sorted(ip for ip in starts if ip < end)
+    namespace = dict()
+    names = dict()  # Python name of each called function and argument
+
+    def nameOf(prefix, v):
+        key = (prefix, id(v))
+        if key not in names:
+            names[key] = "%s%d" % (prefix, len(names))
+            namespace[names[key]] = v
+        return names[key]
+
+    def literal(arg):
+        if arg == None or type(arg) is int: return repr(arg)
+        return nameOf("a", arg)
+
+    def block(lines, ip, stop, indent):
+        pad = "    " * indent
+        while ip < stop:
+            (fun, arg) = code[ip]
+            if fun is i_pushInteger and type(arg) is int:
+                lines.append(pad + "push(%r)" % (arg,))
+            elif fun in INLINE_PYTHON:
+                lines.append(pad + INLINE_PYTHON[fun])
+            elif fun is i_branch:
+                lines.append(pad + "ip = %d" % (arg,))
+                return
+            elif fun is i_branchIfPositive:
+                lines.append(pad + "ip = %d if pop() > 0 else %d" % (arg, ip + 1))
+                return
+            elif fun is i_call:
+                (target, skip, tail) = arg
+                if not tail:
+                    retaddr = ReturnAddress(returnSite(ip, arg))
+                    lines.append(pad + "push(stack[-1])")
+                    lines.append(pad + "stack[-2] = %s" % (nameOf("r", retaddr),))
+                lines.append(pad + "ip = %d" % (target,))
+                return
+            elif fun is i_return:
+                lines.append(pad + "ip = returnTarget(stack[-2])")
+                lines.append(pad + "stack[-1] = pop()")
+                return
+            else:
+                lines.append(pad + "state.ip = %d" % (ip + 1,))
+                lines.append(pad + "%s(state, %s)" % (nameOf("f", fun), literal(arg)))
+            ip += 1
+        lines.append(pad + "ip = %d" % (stop,))
+
+    def dispatch(lines, first, last, indent):
+        # Select the block starting at ip among starts[first:last] by
+        # bisection; each block ends with `continue`.
+        pad = "    " * indent
+        if last - first == 1:
+            start = starts[first]
+            stop = starts[first + 1] if first + 1 < len(starts) else end
+            lines.append(pad + "if ip == %d:" % (start,))
+            block(lines, start, stop, indent + 1)
+            lines.append(pad + "    continue")
+            return
+        mid = (first + last) // 2
+        lines.append(pad + "if ip < %d:" % (starts[mid],))
+        dispatch(lines, first, mid, indent + 1)
+        lines.append(pad + "else:")
+        dispatch(lines, mid, last, indent + 1)
+
+    lines = ["def program(state):",
+             "    stack = state.stack",
+             "    push = stack.append",
+             "    pop = stack.pop",
+             "    ip = state.ip",
+             "    try:",
+             "        while ip < %d:" % (end,)]
+    if starts: dispatch(lines, 0, len(starts), 3)
+    lines += ["            # Not the start of a block: execute one instruction.",
+              "            state.ip = ip + 1",
+              "            (fun, arg) = code[ip]",
+              "            fun(state, arg)",
+              "            ip = state.ip",
+              "    finally:",
+              "        state.ip = ip",
+              ""]
+    return ("\n".join(lines), namespace)
+
+def compilePython(code):
+    return CompiledProgram(code)
+
+def runCompiled(code, state=None):
+    """Run a code list, or a CompiledProgram compiled in advance. On an
+    error, state.ip is the start of the failing instruction's block."""
+    if state == None: state = EngineState()
+    program = code if isinstance(code, CompiledProgram) else compilePython(code)
+    try:
+        program.function(state)
+    finally:
+        state.flush()
+    return state
+
+#==================== Closure engine ====================
+# The closure engine links each instruction into a closure with its
+# argument, its successor and the stack operations bound, which returns
+# the next closure to execute. Straight-line code thus runs without
+# unpacking instruction tuples or looking up attributes; a branch looks
+# its destination up in the table of closures. Closures are linked to the
+# stack of one EngineState.
+def linkClosures(code, state):
+    """Return the table of closures for `code`, indexed by address; the
+    entry at len(code) is None, which ends the program."""
+    table = [None] * (len(code) + 1)
+    linker = CLOSURE_LINKERS.get
+    # The closures hold no cycles worth collecting, and allocating that
+    # many triggers repeated collections: pause the collector meanwhile.
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        for ip in range(len(code) - 1, -1, -1):
+            (fun, arg) = code[ip]
+            table[ip] = linker(fun, linkCalled)(state, fun, arg, ip, table[ip + 1], table)
+    finally:
+        if collecting: gc.enable()
+    return table
+
+def linkPush(state, fun, arg, ip, nxt, table):
+    push = state.stack.append
+    def c(): push(arg); return nxt
+    return c
+def linkPushMarker(state, fun, arg, ip, nxt, table):
+    push = state.stack.append
+    def c(): push(MARKER); return nxt
+    return c
+def linkPop(state, fun, arg, ip, nxt, table):
+    pop = state.stack.pop
+    def c(): pop(); return nxt
+    return c
+def linkDup(state, fun, arg, ip, nxt, table):
+    stack = state.stack
+    push = stack.append
+    def c(): push(stack[-1]); return nxt
+    return c
+def linkSwap(state, fun, arg, ip, nxt, table):
+    stack = state.stack
+    def c():
+        (stack[-1], stack[-2]) = (stack[-2], stack[-1])
+        return nxt
+    return c
+def linkAdd(state, fun, arg, ip, nxt, table):
+    (push, pop) = (state.stack.append, state.stack.pop)
+    def c(): push(pop() + pop()); return nxt
+    return c
+def linkSub(state, fun, arg, ip, nxt, table):
+    (push, pop) = (state.stack.append, state.stack.pop)
+    def c(): push(pop() - pop()); return nxt
+    return c
+def linkMul(state, fun, arg, ip, nxt, table):
+    (push, pop) = (state.stack.append, state.stack.pop)
+    def c(): push(pop() * pop()); return nxt
+    return c
+def linkBranch(state, fun, arg, ip, nxt, table):
+    def c(): return table[arg]
+    return c
+def linkBranchIfPositive(state, fun, arg, ip, nxt, table):
+    pop = state.stack.pop
+    def c(): return table[arg] if pop() > 0 else nxt
+    return c
+def linkCall(state, fun, arg, ip, nxt, table):
+    (target, skip, tail) = arg
+    if tail:
+        def c(): return table[target]
+        return c
+    stack = state.stack
+    push = stack.append
+    retaddr = ReturnAddress(returnSite(ip, arg))
+    def c():
+        push(stack[-1])
+        stack[-2] = retaddr
+        return table[target]
+    return c
+def linkReturn(state, fun, arg, ip, nxt, table):
+    stack = state.stack
+    pop = stack.pop
+    def c():
+        addr = returnTarget(stack[-2])
+        stack[-1] = pop()
+        return table[addr]
+    return c
+def linkCalled(state, fun, arg, ip, nxt, table):
+    """Instructions without a closure of their own are called as in run()."""
+    ip += 1
+    def c():
+        state.ip = ip
+        fun(state, arg)
+        return nxt
+    return c
+
+CLOSURE_LINKERS = {
+    i_pushInteger: linkPush,
+    i_pushMarker: linkPushMarker,
+    i_pop: linkPop,
+    i_dup: linkDup,
+    i_swap: linkSwap,
+    i_add: linkAdd,
+    i_sub: linkSub,
+    i_mul: linkMul,
+    i_branch: linkBranch,
+    i_branchIfPositive: linkBranchIfPositive,
+    i_call: linkCall,
+    i_return: linkReturn,
+}
+
+def runClosures(code, state=None):
+    if state == None: state = EngineState()
+    return executeClosures(linkClosures(code, state), state)
+
+def executeClosures(table, state):
+    """Run closures linked to `state` from state.ip. As in run(), on an
+    error state.ip is the address after the failing instruction."""
+    c = table[state.ip] if state.ip < len(table) else None
+    try:
+        while c is not None:
+            c = c()
+    finally:
+        state.ip = table.index(c) + 1 if c is not None else len(table) - 1
+        state.flush()
+    return state
+
+ENGINES = {
+    "tuple": run,
+    "bytecode": runBytecode,
+    "python": runCompiled,
+    "closure": runClosures,
+}
@@ -0,0 +1,206 @@
+"""Execution server: runs Dull programs submitted as JSON lines, keeping
+assembled programs in memory, so that a short program costs a cache
+lookup and its run rather than a process launch.
+
+Each job is a JSON object on one line; only "source" is required:
+
+    {"id": 1, "source": "...", "stdin": "", "engine": "tuple",
+     "optimize": false, "instructions": null, "seconds": null}
+
+and each result a JSON object on one line:
+
+    {"id": 1, "stdout": "...", "error": null, "cached": true,
+     "executed": 1234, "timings": {"assemble": 0.0001, "run": 0.002}}
+
+"instructions" and "seconds" budget the run (see runFor()), and need the
+tuple engine; "executed" is only counted by it. The server's default
+budgets (--instructions, --seconds) apply to the jobs run by the tuple
+engine which give none; the other engines always run to completion. Jobs
+are read from stdin, with results written to stdout, or from the
+connections to a Unix socket (--socket), with each connection's results
+written back to it.
+
+Jobs run in a pool of worker threads, and results are written as jobs
+finish. The threads share the interpreter lock, so CPU-bound jobs do not
+run in parallel; the pool lets jobs waiting on I/O overlap, and short
+jobs finish while long ones run. A job without a budget which does not
+end holds its worker until the server stops: unless --seconds 0 is
+given, tuple-engine jobs get a default time budget of
+DEFAULT_JOB_SECONDS.
+
+Usage: python -m dull.server [options]
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import argparse
+import io
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+
+from dull.lexer import iterNumberedTokens
+from dull.assembler import assembleWithLines
+from dull.optimizer import optimize
+from dull.verifier import verify
+from dull.runtime import *
+
+DEFAULT_PROGRAM_CACHE_SIZE = 256
+DEFAULT_JOB_SECONDS = 60.0
+
+class ProgramCache:
+    """Assembled programs, by (source, engine, optimize), evicted least
+    recently used first. Safe to use from several threads."""
+    def __init__(self, capacity=DEFAULT_PROGRAM_CACHE_SIZE):
+        self.capacity = capacity
+        self.programs = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, source, engine="tuple", optimized=False):
+        """Return (program, whether it was cached)."""
+        key = (source, engine, optimized)
+        with self.lock:
+            program = self.programs.get(key)
+            if program != None:
+                self.programs.move_to_end(key)
+                self.hits += 1
+                return (program, True)
+            self.misses += 1
+        # Assembled outside the lock; concurrent misses may both assemble.
+        program = loadProgram(source, engine, optimized)
+        with self.lock:
+            self.programs[key] = program
+            while len(self.programs) > self.capacity:
+                self.programs.popitem(last=False)
+        return (program, False)
+
+def loadProgram(source, engine, optimized):
+    """Assemble and verify `source`, encoded for `engine`."""
+    (code, labelMap, lineMap) = assembleWithLines(iterNumberedTokens([source]))
+    if optimized: code = optimize(code, labelMap)
+    verify(code)
+    if engine == "bytecode": return compileBytecode(code)
+    if engine == "python": return compilePython(code)
+    return code
+
+class Server:
+    def __init__(self, workers=None, cacheSize=DEFAULT_PROGRAM_CACHE_SIZE,
+                 instructions=None, seconds=None):
+        self.pool = ThreadPoolExecutor(workers)
+        self.programs = ProgramCache(cacheSize)
+        # Default budgets, for tuple-engine jobs which give none:
+        self.instructions = instructions
+        self.seconds = seconds
+
+    def submit(self, line, reply):
+        """Run the job on a line of JSON in the pool, passing its result
+        line to reply(). Returns the future of the job."""
+        return self.pool.submit(lambda: reply(json.dumps(self.runLine(line)) + "\n"))
+
+    def runLine(self, line):
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict): raise ValueError("A job must be a JSON object")
+        except ValueError as e:
+            return {"id": None, "error": "Invalid job: %s" % (e,)}
+        return self.runJob(job)
+
+    def runJob(self, job):
+        result = {"id": job.get("id"), "stdout": "", "error": None, "cached": False,
+                  "executed": None, "timings": {"assemble": None, "run": None}}
+        if "source" not in job:
+            result["error"] = "Invalid job: missing 'source'"
+            return result
+        out = io.BytesIO()
+        try:
+            engine = job.get("engine", "tuple")
+            if engine not in ENGINES: raise ValueError("Unknown engine: %r" % (engine,))
+            if engine == "tuple":
+                instructions = job.get("instructions", self.instructions)
+                seconds = job.get("seconds", self.seconds)
+            elif job.get("instructions") != None or job.get("seconds") != None:
+                raise ValueError("Budgets need the tuple engine")
+            t0 = time.perf_counter()
+            (program, result["cached"]) = self.programs.get(
+                job["source"], engine, bool(job.get("optimize")))
+            t1 = time.perf_counter()
+            result["timings"]["assemble"] = t1 - t0
+            state = EngineState(out=out, inp=io.BytesIO(job.get("stdin", "").encode("utf-8")))
+            try:
+                if engine == "tuple":
+                    runFor(program, state, instructions, seconds)
+                    result["executed"] = state.executed
+                    if state.ip < len(program):
+                        raise ExecutionError("Budget exhausted after %d instructions" %
+                                             (state.executed,))
+                else:
+                    ENGINES[engine](program, state)
+            finally:
+                result["timings"]["run"] = time.perf_counter() - t1
+        except Exception as e:
+            result["error"] = "%s: %s" % (type(e).__name__, e)
+        result["stdout"] = out.getvalue().decode("utf-8", "surrogatepass")
+        return result
+
+    def serveStream(self, inp, out):
+        """Run the jobs read from `inp`, writing results to `out`, until the
+        end of the input and of its jobs."""
+        lock = threading.Lock()
+        def reply(text):
+            with lock:
+                out.write(text)
+                out.flush()
+        wait([self.submit(line, reply) for line in inp if line.strip()])
+
+    def serveSocket(self, path):
+        """Serve connections to a Unix socket at `path` until interrupted."""
+        jobs = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                lock = threading.Lock()
+                def reply(text):
+                    with lock:
+                        self.wfile.write(text.encode("utf-8"))
+                        self.wfile.flush()
+                wait([jobs.submit(line, reply) for line in self.rfile if line.strip()])
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+            self.socketServer = server
+            try:
+                server.serve_forever()
+            finally:
+                os.unlink(path)
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+def main(args):
+    parser = argparse.ArgumentParser(prog="python -m dull.server")
+    parser.add_argument("--socket", metavar="PATH",
+                        help="listen on a Unix socket at PATH (default: read jobs from stdin)")
+    parser.add_argument("-j", "--workers", type=int, default=None, metavar="N",
+                        help="number of worker threads")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_PROGRAM_CACHE_SIZE, metavar="N",
+                        help="number of assembled programs kept (default: %(default)s)")
+    parser.add_argument("--instructions", type=int, metavar="N",
+                        help="default instruction budget per job")
+    parser.add_argument("--seconds", type=float, default=DEFAULT_JOB_SECONDS, metavar="S",
+                        help="default time budget per job (default: %(default)s; 0: none)")
+    args = parser.parse_args(args)
+    server = Server(args.workers, args.cache_size, args.instructions, args.seconds or None)
+    try:
+        if args.socket:
+            server.serveSocket(args.socket)
+        else:
+            server.serveStream(sys.stdin, sys.stdout)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
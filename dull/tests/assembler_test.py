@@ -65,3 +65,89 @@ def test_output():
 def test_create_array():
     s = "all workand no play makes Jack a dull boy"
     assert tokensToCode(tokenize(s)) == [(i_createArray,None)]
+
+def test_streaming_tokens():
+    import io
+    from dull.lexer import iterTokens
+    s = "all work abnd noz play\nmakes Jack a dull boy!\n"
+    assert tokensToCode(iterTokens(io.StringIO(s))) == tokensToCode(tokenize(s))
+
+def test_array_replacements():
+    # QWERTY neighbours of 'k' (in "work"): j l i o m ,
+    for (c, ins) in [("j", i_arrayStore), ("l", i_arrayFetch), ("o", i_arrayGetSize),
+                     ("i", i_arrayResize), ("m", i_arrayRangeCopy)]:
+        s = "all wor%s and no play makes Jack a dull boy" % c
+        assert tokensToCode(tokenize(s)) == [(ins, None)]
+
+def test_unrecognized_replacement():
+    from dull.assembler import SyntaxError
+    import pytest
+    for c in ["x", ","]:
+        with pytest.raises(SyntaxError):
+            tokensToCode(tokenize("all wor%s and no play makes Jack a dull boy" % c))
+
+#==================== Control flow: ==============================
+import pytest
+from dull.assembler import SyntaxError, assemble
+
+def test_conditional_backward_branch():
+    s = "All, work and no play makes Jack a dull boy,"
+    assert tokensToCode(tokenize(s)) == [(i_branchIfPositive, 0)]
+
+def test_backward_branch():
+    s = "All, work abnd no play makes Jack a dull boy;"
+    assert tokensToCode(tokenize(s)) == [(i_pushInteger, 2), (i_branch, 0)]
+
+def test_forward_branch_without_destination():
+    for s in ["All work and no play makes Jack a dull boy:",
+              "All work and no play makes Jack a dull boy."]:
+        with pytest.raises(SyntaxError):
+            tokensToCode(tokenize(s))
+
+def test_branch_without_label():
+    with pytest.raises(SyntaxError):
+        tokensToCode(tokenize("all work and no play makes Jack a dull boy;"))
+
+def test_call():
+    s = "All work and no play makes Jack a dull boy..."
+    assert assemble(tokenize(s)) == ([(i_call, (0, 0, False))], {"All": [0]})
+
+def test_return():
+    s = "all work and no play makes Jack a dull boy..."
+    assert tokensToCode(tokenize(s)) == [(i_return, None)]
+
+def test_ellipsis_followed_by_punctuation():
+    s = "all work and no play makes Jack a dull boy...!"
+    assert tokensToCode(tokenize(s)) == [(i_return, None), (i_output, None)]
+    s = "All work and no play makes Jack a dull boy...,"
+    assert tokensToCode(tokenize(s)) == [(i_call, (0, 1, False)), (i_branchIfPositive, 0)]
+
+def test_call_returns_to_following_line():
+    from dull.lexer import iterNumberedTokens
+    from dull.assembler import assembleWithLines
+    s = ("All work and no play makes Jack a dull aboy...!\n"
+         "all work and no play makes jack a dull bboy!\n")
+    code = [(i_pushInteger, 1), (i_call, (0, 1, False)), (i_output, None),
+            (i_dup, None), (i_output, None)]
+    assert tokensToCode(tokenize(s)) == code
+    assert assembleWithLines(iterNumberedTokens([s]))[0] == code
+    # A line going on after the ellipsis takes line numbers to tell:
+    s = "All work and no play makes Jack a dull boy... all work and no play makes jack a dull aboy\n"
+    assert assembleWithLines(iterNumberedTokens([s]))[0] == [(i_call, (0, 1, False)),
+                                                             (i_pushInteger, 1)]
+
+def test_calls_returning_to_a_return_are_tail_calls():
+    from dull.assembler import markTailCalls
+    code = [(i_call, (3, 1, False)), (i_pushInteger, 1), (i_return, None),
+            (i_call, (0, 0, False)), (i_call, (0, 0, True))]
+    markTailCalls(code)
+    assert [arg for (fun, arg) in code[::3]] == [(3, 1, True), (0, 0, False)]
+    assert code[4] == (i_call, (0, 0, False))
+
+def test_label_resolution_uses_position_in_label_map():
+    from dull.assembler import LBL_AFTER, LBL_BEFORE, LBL_UNIQUE, resolveLabels
+    labelMap = {"A": [0, 3, 7], "B": [5]}
+    code = [(i_branch, LBL_AFTER, "A", 1), (i_branch, LBL_BEFORE, "A", 1),
+            (i_branchIfPositive, LBL_AFTER, "A", 2), (i_call, LBL_UNIQUE, "B", 0, 1)]
+    resolveLabels(code, labelMap)
+    assert code == [(i_branch, 3), (i_branch, 0), (i_branchIfPositive, 7), (i_call, (5, 1, False))]
@@ -0,0 +1,91 @@
+import os
+import time
+
+from dull.lexer import iterTokens, tokenize
+from dull.assembler import tokensToCode
+from dull.runtime import *
+from dull.cache import CodeCache, sourceKey, loadOrAssemble
+
+SRC = "All workh and no play makoes Jakc a dull boy!\n"
+
+def assemble(f): return tokensToCode(iterTokens(f))
+
+def test_key_depends_on_source_and_options():
+    k = sourceKey([SRC.encode()])
+    assert k == sourceKey([SRC[:10].encode(), SRC[10:].encode()])
+    assert k != sourceKey([SRC.encode() + b"x"])
+    assert k != sourceKey([SRC.encode()], options=["opt"])
+
+def test_store_and_load(tmp_path):
+    cache = CodeCache(str(tmp_path))
+    code = tokensToCode(tokenize(SRC))
+    assert cache.load("k") == None
+    cache.store("k", code)
+    assert cache.load("k") == code
+
+def test_corrupt_entry_is_ignored(tmp_path):
+    cache = CodeCache(str(tmp_path))
+    with open(cache.path("k"), "wb") as f: f.write(b"garbage")
+    assert cache.load("k") == None
+    assert not os.path.exists(cache.path("k"))
+
+def test_eviction_of_least_recently_used(tmp_path):
+    code = [(i_pushInteger, 1)] * 100
+    cache = CodeCache(str(tmp_path), maxBytes=10**6)
+    cache.store("old", code)
+    cache.store("new", code)
+    past = time.time() - 100
+    os.utime(cache.path("old"), (past, past))
+    cache.maxBytes = os.path.getsize(cache.path("new")) * 2
+    cache.store("newest", code)
+    assert cache.load("old") == None
+    assert cache.load("new") == code
+    assert cache.load("newest") == code
+
+def test_clear(tmp_path):
+    cache = CodeCache(str(tmp_path))
+    cache.store("k", [(i_pop, None)])
+    cache.clear()
+    assert cache.entries() == []
+
+def test_load_or_assemble(tmp_path):
+    srcfile = tmp_path / "prog.dull"
+    srcfile.write_text(SRC)
+    cache = CodeCache(str(tmp_path / "cache"))
+    calls = []
+    def counting(f):
+        calls.append(1)
+        return assemble(f)
+    code = loadOrAssemble(str(srcfile), counting, cache)
+    assert loadOrAssemble(str(srcfile), counting, cache) == code
+    assert len(calls) == 1
+    srcfile.write_text(SRC.replace("!", "?"))
+    assert loadOrAssemble(str(srcfile), counting, cache) != code
+    assert len(calls) == 2
+
+def test_interpreter_version_covers_code_producing_modules(tmp_path):
+    import shutil
+    import dull.cache
+    from dull.cache import CODE_MODULES, computeInterpreterVersion
+    pkgDir = os.path.dirname(os.path.abspath(dull.cache.__file__))
+    # Every module on the path from source to code:
+    assert set(CODE_MODULES) >= {"lexer", "assembler", "optimizer", "runtime", "cache"}
+    for name in CODE_MODULES:
+        shutil.copy(os.path.join(pkgDir, name + ".py"), str(tmp_path))
+    version = computeInterpreterVersion(str(tmp_path))
+    for name in CODE_MODULES:
+        with open(str(tmp_path / (name + ".py")), "a") as f:
+            f.write("\n# changed\n")
+        changed = computeInterpreterVersion(str(tmp_path))
+        assert changed != version, name
+        version = changed
+
+def test_store_and_load_bytecode(tmp_path):
+    from dull.runtime import Bytecode, compileBytecode
+    cache = CodeCache(str(tmp_path))
+    bc = compileBytecode([(i_pushInteger, 3), (i_output, None), (i_branch, 0)])
+    cache.store("k", bc)
+    loaded = cache.load("k")
+    assert isinstance(loaded, Bytecode)
+    assert loaded.code == bc.code
+    assert loaded.ops == bc.ops and loaded.operands == bc.operands
@@ -0,0 +1,101 @@
+import random
+
+import pytest
+
+from dull.lexer import tokenize
+from dull.assembler import assemble
+from dull.runtime import i_call
+from dull.incremental import *
+
+def line(letter="", end=""):
+    """A repetition of the reference text, inserting a letter before "boy"
+    and a punctuation mark at the end."""
+    return "all work and no play makes jack a dull %sboy%s\n" % (letter, end)
+
+SOURCE = ("All wrok and no pl\n" "ay makes Jack a dull boy\n" + line("a", "!") + line("g") +
+          line("c", "...") + line("x", ","))
+
+def assembleAll(src):
+    try:
+        return assemble(tokenize(src))
+    except Exception as e:
+        return type(e)
+
+def test_initial_assembly():
+    program = IncrementalProgram(SOURCE)
+    assert (program.code, program.labelMap) == assemble(tokenize(SOURCE))
+
+def test_edit_relexes_only_changed_lines():
+    lines = SOURCE.splitlines(True)
+    program = IncrementalProgram(SOURCE)
+    lines[3] = line("z")
+    assert program.setSource("".join(lines)) == assemble(tokenize("".join(lines)))
+    assert program.relexedLines == 1
+    # Inserting and deleting lines:
+    lines[4:4] = [line("d"), line(end="!")]
+    assert program.setSource("".join(lines)) == assemble(tokenize("".join(lines)))
+    assert program.relexedLines == 2
+    del lines[2:4]
+    assert program.setSource("".join(lines)) == assemble(tokenize("".join(lines)))
+    assert program.relexedLines == 0
+
+def test_edit_relexes_until_back_in_step():
+    # Deleting the line break in the reference text shifts the reference
+    # position for the rest of its line:
+    lines = SOURCE.splitlines(True)
+    program = IncrementalProgram(SOURCE)
+    lines[0:2] = ["All wrok and no plXay makes Jack a dull boy\n"]
+    src = "".join(lines)
+    assert program.setSource(src) == assemble(tokenize(src))
+
+def test_trailing_dots_assembled_at_end():
+    # An ellipsis ending the program, assembled when the program ends...
+    program = IncrementalProgram(SOURCE)
+    src = SOURCE + line(end="...")
+    assert program.setSource(src) == assemble(tokenize(src))
+    assert program.code[-1][0] == i_call
+    # ... or before the next instruction:
+    src = SOURCE + line(end="...") + line("e")
+    assert program.setSource(src) == assemble(tokenize(src))
+    assert program.code[-2][0] == i_call
+
+def test_call_returns_to_following_line():
+    lines = SOURCE.splitlines(True)
+    program = IncrementalProgram(SOURCE)
+    for (n, text, skip) in [(4, line("c", "...!"), 1), (5, line("b", "!"), 1), (4, line("c", "..."), 0)]:
+        lines[n] = text
+        src = "".join(lines)
+        assert program.setSource(src) == assemble(tokenize(src))
+        assert [arg[1] for (fun, arg) in program.code if fun == i_call] == [skip]
+
+def test_syntax_error_leaves_program_unchanged():
+    program = IncrementalProgram(SOURCE)
+    before = (list(program.code), dict(program.labelMap), list(program.lines))
+    with pytest.raises(Exception):
+        program.setSource(SOURCE + "all xyork\n")
+    assert (program.code, program.labelMap, program.lines) == before
+    src = SOURCE + line("y")
+    assert program.setSource(src) == assemble(tokenize(src))
+
+def test_random_edits_match_full_assembly():
+    rnd = random.Random(7)
+    pieces = [line("a"), line(end="!"), line("z"), line(end=","), line(end=";"), line(end="..."),
+              line(end="."), "\n", "all xyork\n", "All work\n",
+              "and no play makes Jack a dull boy\n", "All Wrok\n"]
+    program = IncrementalProgram("")
+    lines = []
+    for n in range(400):
+        candidate = list(lines)
+        i = rnd.randrange(len(candidate) + 1)
+        j = min(len(candidate), i + rnd.randrange(3))
+        candidate[i:j] = [rnd.choice(pieces) for k in range(rnd.randrange(3))]
+        src = "".join(candidate)
+        expected = assembleAll(src)
+        try:
+            result = program.setSource(src)
+        except Exception as e:
+            result = type(e)
+        assert result == expected
+        if not isinstance(result, type):
+            lines = candidate
+        assert (program.code, program.labelMap) == assemble(tokenize("".join(lines)))
@@ -3,6 +3,9 @@ from dull.lexer import *
 
 def tokens(s): return dull.lexer.tokenize(s)
 
+# A repetition of the reference text with a letter inserted before "boy":
+def push(c): return "all work and no play makes jack a dull %sboy\n" % (c,)
+
 def test_empty_source():
     assert tokens("") == []
 
@@ -69,6 +72,14 @@ def test_deletion():
 def test_insertion():
     assert tokens("all work and no polay makes Jack a dull boy\n") == [LabelToken(""), InsertionToken("o")]
 
+def test_reference_repeats():
+    src = "All work and no play makes Jack a dull boy\n" * 2 + "all work and no pllay makes jack a dull boy!\n"
+    assert tokens(src) == [LabelToken("All"), DoublingToken("l"), InsertionToken("!", True)]
+    # Repetitions need not start on a new line:
+    src = "All work and no play makes Jack a dull boy all work\nand no play makes jack a dull boy!\n"
+    assert tokens(src) == [LabelToken("All"), InsertionToken("!", True)]
+    assert tokens(src) == dull.lexer.tokenizeByPatterns(src)
+
 def test_all_mutations_in_one_line():
     assert tokens("aallw ork amdno plkay makes Jack a dull boy\n") == [
         LabelToken(""),
@@ -150,3 +161,133 @@ def test_end_punctuation():
     assert tokens(ref + "...") == [
         LabelToken(""),
         InsertionToken(".", True), InsertionToken(".", True), InsertionToken(".", True)]
+
+def test_table_driven_lexer_matches_pattern_trial():
+    import random
+    rnd = random.Random(42)
+    ref = dull.lexer.REFERENCE_TEXT
+    alphabet = "abcdeklmnoxyzAJW .,:;!?'\n"
+    def tokensOrError(f, s):
+        try: return f(s)
+        except Exception as e: return str(e)
+    for n in range(2000):
+        s = list(ref * rnd.randrange(1,3))
+        for k in range(rnd.randrange(0,5)):
+            i = rnd.randrange(len(s))
+            op = rnd.randrange(4)
+            if op==0: s.insert(i, s[i])
+            elif op==1: s[i] = rnd.choice(alphabet)
+            elif op==2: del s[i]
+            else: s.insert(i, rnd.choice(alphabet))
+        s = "".join(s)
+        assert tokensOrError(dull.lexer.tokenize, s) == tokensOrError(dull.lexer.tokenizeByPatterns, s)
+
+def test_streaming_matches_tokenize():
+    import io
+    src = "All work and no pl\nay makes Jack\n#comment\n\n a dull boy!\n all wxork\nand no play makes jack a dull zboy\n"
+    assert list(dull.lexer.iterTokens(io.StringIO(src))) == tokens(src)
+    assert list(dull.lexer.iterTokens(src.splitlines(True))) == tokens(src)
+
+def test_token_equality_and_hashing():
+    assert DoublingToken("l") == DoublingToken("l")
+    assert DoublingToken("l") != DoublingToken("a")
+    assert DoublingToken("l") != DeletionToken("l")
+    assert InsertionToken("x") == InsertionToken("x", False)
+    assert InsertionToken("x") != InsertionToken("x", True)
+    assert hash(ReplacementToken("l","w")) == hash(ReplacementToken("l","w"))
+    assert len({LabelToken("All"), LabelToken("All"), LabelToken("")}) == 2
+    assert repr(InsertionToken("x", True)) == "InsertionToken(['x', True])"
+
+def test_tokens_are_slotted_and_shared():
+    ts = tokens("all work and no pllay makes Jack a dulll boy\n")
+    assert ts == [LabelToken(""), DoublingToken("l"), DoublingToken("l")]
+    assert not hasattr(ts[1], "__dict__")
+    assert ts[1] is ts[2]
+
+#========== Parallel lexing: ========================================
+PARALLEL_SOURCES = [
+    "All work and no play makes Jack a dull boy\n" + ("all work and no play makes jack a dull aboy!\n" + push("g")) * 20,
+    # The reference text continued on later lines, and a label spanning lines:
+    "All work\nand no pl\nay makes Jack a dull boy\n" + "all work\nand no play makes jack a dull xboy?\n" * 10,
+    "All\nWork\nAnd\nno play makes Jack a dull boy\n#comment\n\n" + push("g"),
+    # A syntax error, which the lexer reports whether the chunk's state was guessed or not:
+    "All work and no play makes Jack a dull boy\n" + push("a") + "all xyork\n" + push("g"),
+    "All work\nand no pl\nay makes Jack a dull boy\nall xyork and no play makes jack a dull boy\n",
+]
+
+def test_parallel_lexing_matches_sequential():
+    def tokensOrError(f, s):
+        try: return f(s)
+        except Exception as e: return str(e)
+    for src in PARALLEL_SOURCES:
+        expected = tokensOrError(tokens, src)
+        numbered = tokensOrError(lambda s: list(iterNumberedTokens(s.splitlines(True))), src)
+        for chunkSize in [1, 7, 30, 1000]:
+            assert tokensOrError(lambda s: tokenizeParallel(s, 2, chunkSize), src) == expected
+            assert tokensOrError(lambda s: numberedTokensParallel(s, 2, chunkSize), src) == numbered
+
+def test_parallel_lexing_shares_tokens():
+    ts = tokenizeParallel(PARALLEL_SOURCES[0], 2, 10)
+    assert ts[1] is internToken(InsertionToken, "a", False)
+
+def test_relex_adopts_speculation_once_states_agree():
+    # From the "y" of "boy", the first line replaces the "y"; from the start
+    # of the reference, it inserts two characters. Both end at the start.
+    chunk = ".\n" + push("g") + push("c")
+    speculated = relexChunk(chunk, LINE_START_STATE, None)
+    assert speculated[0][:2] == [InsertionToken(".", False), InsertionToken(" ", False)]
+    (tokens, lineEnds, after) = relexChunk(chunk, 41, speculated)
+    assert tokens[:1] == [ReplacementToken("y", ".")]
+    assert tokens[1:] == speculated[0][2:]
+    assert (lineEnds.tolist(), after) == ([1, 2, 3], [LINE_START_STATE] * 3)
+    assert relexChunk(chunk, 41, None)[0] == tokens
+
+#========== Memory-mapped sources: ========================================
+def test_mapped_source_lines(tmp_path, monkeypatch):
+    path = tmp_path / "src.dull"
+    src = "All work and no play makes Jack a dull boy\r\nb\n\u00e9\rc\n\nd"
+    path.write_bytes(src.encode("utf-8"))
+    with MappedSource(str(path)) as source:
+        assert list(source.lines()) == src.splitlines(True)
+        monkeypatch.setattr(dull.lexer, "MAPPED_BLOCK_SIZE", 1)
+        assert list(source.lines()) == src.splitlines(True)
+        spans = source.spans(5)
+        assert [s[1:] for s in spans] == [(0, 44), (44, 7), (51, 2)]
+        assert list(chunkLines(spans[1])) == ["b\n", "\u00e9\r", "c\n"]
+    path.write_bytes(b"")
+    with MappedSource(str(path)) as source:
+        assert (len(source), list(source.lines()), source.spans(5)) == (0, [], [])
+
+def test_parallel_lexing_of_mapped_source(tmp_path):
+    path = tmp_path / "src.dull"
+    for src in PARALLEL_SOURCES[:3]:
+        path.write_bytes(src.encode("utf-8"))
+        with MappedSource(str(path)) as source:
+            for chunkSize in [1, 30, 1000]:
+                assert tokenizeParallel(source, 2, chunkSize) == tokens(src)
+
+#========== Line cache: ========================================
+def test_line_cache_matches_tokenize():
+    line = "all work and no  play makes jack a dull aboy!\n"
+    src = "All work and no play makes Jack a dull boy\n" + (line + "  " + line) * 5
+    cache = LineCache()
+    assert tokenize(src, cache) == tokens(src)
+    info = cache.info()
+    # Padding is normalised away, so only the first of the repeated lines misses:
+    assert (info.hits, info.misses) == (9, 2)
+    assert list(iterTokens(src.splitlines(True), cache)) == tokens(src)
+    assert cache.info().hits == 20
+
+def test_line_cache_keyed_on_state():
+    # The line break after "a" is a space of the reference text on one line,
+    # and an insertion on another:
+    src = "All work and no play makes Jack\na\ndull boy\na\n"
+    cache = LineCache()
+    assert tokenize(src, cache) == [LabelToken("All"), InsertionToken(" ", False)]
+    assert cache.info().hits == 0
+
+def test_line_cache_capacity():
+    cache = LineCache(capacity=2)
+    tokenize("All work and no play makes Jack a dull boy\n" + push("a") + push("g") + push("c") + push("a"), cache)
+    info = cache.info()
+    assert (info.hits, info.misses, info.currsize) == (0, 5, 2)
@@ -0,0 +1,87 @@
+import random
+
+from dull.runtime import *
+from dull.optimizer import optimize
+
+def test_constant_folding():
+    code = [(i_pushInteger, 7), (i_pushInteger, 3), (i_sub, None),
+            (i_pushInteger, 5), (i_mul, None), (i_pushInteger, 1), (i_add, None)]
+    assert optimize(code) == [(i_pushInteger, 1 + 5*(3-7))]
+
+def test_dead_push_pop():
+    assert optimize([(i_pushInteger, 1), (i_dup, None), (i_pop, None)]) == [(i_pushInteger, 1)]
+    assert optimize([(i_pushInteger, 1), (i_pop, None), (i_pop, None)]) == [(i_pop, None)]
+    assert optimize([(i_pushMarker, None), (i_pop, None)]) == []
+
+def test_swap_pairs():
+    code = [(i_pushInteger, 1), (i_dup, None), (i_swap, None), (i_swap, None), (i_add, None)]
+    assert optimize(code) == [(i_pushInteger, 1), (i_dup, None), (i_add, None)]
+    assert optimize([(i_pushInteger, 1), (i_pushInteger, 2), (i_swap, None)]) == [
+        (i_pushInteger, 2), (i_pushInteger, 1)]
+
+def test_constant_array():
+    code = [(i_pushMarker, None), (i_pushInteger, 1), (i_pushInteger, 2), (i_createArray, None)]
+    assert optimize(code) == [(i_pushConstantArray, (1, 2))]
+    assert run(optimize(code)).stack == [makeArray([1, 2])]
+    # Each execution creates a new array:
+    code = [(i_pushConstantArray, (1,)), (i_dup, None), (i_pushConstantArray, (1,))]
+    state = run(code)
+    assert state.stack[0] is state.stack[1]
+    assert state.stack[0] is not state.stack[2]
+
+def test_labels_are_barriers():
+    code = [(i_pushInteger, 1), (i_pushInteger, 2), (i_add, None), (i_dup, None), (i_pop, None)]
+    labelMap = {"L": [2, 5]}
+    assert optimize(code, labelMap) == [(i_pushInteger, 1), (i_pushInteger, 2), (i_add, None)]
+    assert labelMap == {"L": [2, 3]}
+
+def test_target_of_removed_code_is_a_barrier():
+    code = [(i_pushInteger, 1), (i_dup, None), (i_pop, None), (i_pushInteger, 2), (i_add, None)]
+    labelMap = {"L": [1]}
+    assert optimize(code, labelMap) == [(i_pushInteger, 1), (i_pushInteger, 2), (i_add, None)]
+    assert labelMap == {"L": [1]}
+
+def test_branch_addresses_are_remapped():
+    code = [(i_pushMarker, None), (i_pop, None), (i_pushInteger, 1), (i_branch, 2)]
+    assert optimize(code) == [(i_pushInteger, 1), (i_branch, 0)]
+
+def test_underflows_are_kept():
+    # Removing these would hide the underflow run() raises:
+    for code in [[(i_dup, None), (i_pop, None)],
+                 [(i_pushInteger, 1), (i_swap, None), (i_swap, None)]]:
+        assert optimize(code) == code
+    # Nor when the stack is deep enough on one path only:
+    code = [(i_pushInteger, 1), (i_branchIfPositive, 3), (i_pushInteger, 2), (i_dup, None), (i_pop, None)]
+    assert optimize(code) == code
+
+def test_optimized_code_computes_the_same():
+    rnd = random.Random(7)
+    choices = [i_pushInteger, i_pushInteger, i_pushInteger, i_pushMarker,
+               i_add, i_sub, i_mul, i_dup, i_pop, i_swap, i_createArray]
+    for n in range(500):
+        code = []
+        for i in range(rnd.randrange(1, 20)):
+            fun = rnd.choice(choices)
+            code.append((fun, rnd.randrange(1, 27) if fun == i_pushInteger else None))
+        try:
+            expected = run(list(code)).stack
+        except (IndexError, TypeError) as e:
+            expected = type(e)
+        try:
+            result = run(optimize(code)).stack
+        except (IndexError, TypeError) as e:
+            result = type(e)
+        assert result == expected, code
+
+def test_line_map_follows_rewrites():
+    code = [(i_pushInteger, 1), (i_pushInteger, 2), (i_add, None), (i_dup, None), (i_pop, None), (i_output, None)]
+    lineMap = [1, 2, 2, 3, 3, 4]
+    assert optimize(code, None, lineMap) == [(i_pushInteger, 3), (i_output, None)]
+    assert lineMap == [1, 4]
+
+def test_call_addresses_remapped():
+    # The dead push, pop between the call and its return address goes:
+    code = [(i_pushInteger, 5), (i_call, (5, 2, False)), (i_pushInteger, 1), (i_pop, None),
+            (i_branch, 7), (i_dup, None), (i_return, None)]
+    assert optimize(code) == [(i_pushInteger, 5), (i_call, (3, 0, False)), (i_branch, 5),
+                              (i_dup, None), (i_return, None)]
@@ -0,0 +1,49 @@
+import io
+import pstats
+
+from dull.lexer import iterNumberedTokens
+from dull.assembler import assembleWithLines
+from dull.runtime import *
+from dull.profiler import DebugInfo, Profile, runProfiled
+
+SRC = "All, work and no play\n\nmakes Jack xa dull boy,\n"
+
+def profiled(code):
+    prof = Profile(code)
+    runProfiled(code, prof, EngineState(out=io.BytesIO()))
+    return prof
+
+def test_counts_jumps_and_depth():
+    # 3; L: 1 swap sub dup branchIfPositive(L)
+    code = [(i_pushInteger, 3), (i_pushInteger, 1), (i_swap, None),
+            (i_sub, None), (i_dup, None), (i_branchIfPositive, 1)]
+    prof = profiled(code)
+    assert prof.counts == [1, 3, 3, 3, 3, 3]
+    assert prof.jumps == [0, 0, 0, 0, 0, 2]
+    assert prof.maxDepth == 2
+    assert prof.opcodeTotals()["i_pushInteger"][0] == 4
+
+def test_debug_info_maps_addresses_to_lines_and_labels():
+    (code, labelMap, lineMap) = assembleWithLines(iterNumberedTokens([SRC]))
+    assert code == [(i_pushInteger, 24), (i_branchIfPositive, 0)]
+    assert list(lineMap) == [3, 3]
+    info = DebugInfo("prog.dull", labelMap, lineMap)
+    assert info.label(1) == "All"
+    assert info.describe(1) == "prog.dull:3 [All] @1"
+
+def test_report_and_dumps(tmp_path):
+    code = [(i_pushInteger, 3), (i_pushInteger, 1), (i_swap, None),
+            (i_sub, None), (i_dup, None), (i_branchIfPositive, 1)]
+    info = DebugInfo("prog.dull", {"L": [1]}, [1, 2, 2, 2, 3, 3])
+    prof = profiled(code)
+    report = prof.report(info)
+    assert "Hot lines:" in report
+    assert "prog.dull:3 [L] @5" in report
+    path = str(tmp_path / "prof.pstats")
+    prof.writePstats(path, info)
+    stats = pstats.Stats(path).stats
+    assert stats[("prog.dull", 2, "L:i_pushInteger")][0] == 3
+    path = str(tmp_path / "prof.txt")
+    prof.writeCollapsed(path, info)
+    with open(path) as f:
+        assert f.read().startswith("-;line 1;i_pushInteger ")
@@ -0,0 +1,371 @@
+import glob
+import os
+import sys
+
+from dull.lexer import tokenize
+from dull.assembler import tokensToCode
+from dull.runtime import *
+
+def compile(s): return tokensToCode(tokenize(s))
+
+def finalStack(engine, code):
+    return engine(code).stack
+
+def assertEnginesAgree(code):
+    expected = finalStack(run, code)
+    for (name, engine) in ENGINES.items():
+        assert finalStack(engine, code) == expected, name
+    return expected
+
+#========== Engines: ========================================
+def test_engines_on_arithmetic():
+    code = [(i_pushInteger, 7), (i_pushInteger, 3), (i_sub, None),
+            (i_pushInteger, 5), (i_mul, None), (i_dup, None), (i_add, None),
+            (i_pushInteger, 2), (i_swap, None), (i_pop, None),
+            (i_pushInteger, 2**70), (i_pushInteger, 1), (i_add, None)]
+    assert assertEnginesAgree(code) == [2, 2**70 + 1]
+
+def test_engines_on_sources():
+    for s in ["all work abnd noz play makes Jack a dull boy",
+              "all work abnd noz paly makes Jack a dull boy",
+              "all wxork aand no play mkaes Jack a dull boy",
+              "all work abnd nco lpay makes Jack a dull boy"]:
+        assertEnginesAgree(compile(s))
+
+def test_engines_on_examples(capsys):
+    examples = os.path.join(os.path.dirname(__file__), "..", "..", "examples")
+    for path in glob.glob(os.path.join(examples, "*.dull")):
+        with open(path) as f:
+            code = compile(f.read())
+        outputs = []
+        for engine in ENGINES.values():
+            engine(code)
+            outputs.append(capsys.readouterr().out)
+        assert outputs == [outputs[0]] * len(outputs)
+
+def test_bytecode_encoding():
+    bc = compileBytecode([(i_pushInteger, 3), (i_output, None), (i_pushInteger, 2**64)])
+    assert list(bc.ops) == [OP_PUSH, OP_CALL, OP_CALL]
+    assert list(bc.operands) == [3, 1, 2]
+
+def countdownLoop(n):
+    # n; L: 1 swap sub dup branchIfPositive(L)
+    return [(i_pushInteger, n), (i_pushInteger, 1), (i_swap, None),
+            (i_sub, None), (i_dup, None), (i_branchIfPositive, 1),
+            (i_branch, 8), (i_pushInteger, 99)]
+
+def test_engines_on_loops():
+    assert assertEnginesAgree(countdownLoop(100)) == [0]
+
+def test_python_blocks():
+    source = compilePython(countdownLoop(3)).source
+    # Blocks start at the program start, the loop and after each branch:
+    for start in [0, 1, 6, 7]:
+        assert "if ip == %d:" % (start,) in source
+    assert "push(pop() - pop())" in source
+
+def test_python_code_object_cached():
+    compilePython(countdownLoop(17))
+    before = compilePythonSource.cache_info().hits
+    program = compilePython(countdownLoop(17))
+    assert compilePythonSource.cache_info().hits == before + 1
+    assert runCompiled(program).stack == [0]
+
+def test_python_resumes_inside_block():
+    state = EngineState()
+    state.stack.extend([10, 1])
+    state.ip = 2    # In the middle of the loop block
+    assert runCompiled(countdownLoop(5), state).stack == [0]
+    assert state.ip == 8
+
+def test_python_error_position():
+    state = EngineState()
+    code = [(i_pushInteger, 1), (i_branch, 2), (i_pushInteger, 5), (i_add, None), (i_add, None)]
+    with pytest.raises(IndexError):
+        runCompiled(code, state)
+    assert state.ip == 2
+
+def test_closures_linked_to_successors():
+    state = EngineState()
+    table = linkClosures(countdownLoop(3), state)
+    assert len(table) == 9 and table[8] is None
+    assert table[0]() is table[1] and state.stack == [3]
+    state.ip = 1
+    assert executeClosures(table, state).stack == [0]
+
+def test_closures_resume_and_error_position():
+    state = EngineState()
+    state.stack.extend([10, 1])
+    state.ip = 2
+    assert runClosures(countdownLoop(5), state).stack == [0]
+    assert state.ip == 8
+    state = EngineState()
+    code = [(i_pushInteger, 1), (i_branch, 3), (i_pushInteger, 5), (i_add, None)]
+    with pytest.raises(IndexError):
+        runClosures(code, state)
+    assert state.ip == 4
+
+#========== Budgets: ========================================
+def test_run_for_instructions():
+    code = countdownLoop(10)
+    state = EngineState()
+    slices = 0
+    while state.ip < len(code):
+        runFor(code, state, instructions=7)
+        slices += 1
+    assert state.stack == [0]
+    assert state.executed == 1 + 5 * 10 + 1
+    assert slices == (state.executed + 6) // 7
+    assert runFor(code, EngineState(), instructions=3).stack == [1, 10]
+
+def test_run_for_seconds():
+    state = runFor([(i_branch, 0)], seconds=0.01)
+    assert state.ip == 0 and state.executed >= TIME_SLICE
+    executed = state.executed
+    runFor([(i_branch, 0)], state, instructions=5, seconds=10)
+    assert state.executed == executed + 5
+
+def test_run_for_counts_failing_instruction():
+    state = EngineState()
+    with pytest.raises(IndexError):
+        runFor([(i_pushInteger, 1), (i_add, None), (i_pop, None)], state)
+    assert (state.ip, state.executed) == (2, 2)
+
+#========== Preallocated stack: ========================================
+def test_engines_on_preallocated_stack():
+    for engine in ENGINES.values():
+        state = EngineState(stack=PreallocatedStack(capacity=1))
+        assert engine(countdownLoop(20), state).stack == [0]
+        assert state.stack.highWater == 2
+
+def test_preallocated_stack_underflow():
+    stack = PreallocatedStack([1])
+    with pytest.raises(ExecutionError, match="2 values needed, 1 on the stack"):
+        stack[-2]
+    assert stack.pop() == 1
+    with pytest.raises(ExecutionError, match="empty"):
+        stack.pop()
+    for engine in ENGINES.values():
+        with pytest.raises(ExecutionError, match="underflow"):
+            engine([(i_pushInteger, 1), (i_add, None)],
+                   EngineState(stack=PreallocatedStack()))
+
+def test_preallocated_stack_maximum_depth():
+    stack = PreallocatedStack(range(4), capacity=2, maxDepth=4)
+    assert (stack, len(stack), stack[-1], stack.highWater) == ([0, 1, 2, 3], 4, 3, 4)
+    with pytest.raises(ExecutionError, match="more than 4"):
+        stack.append(4)
+    stack.clear()
+    assert stack == [] and stack.highWater == 4
+    with pytest.raises(ExecutionError, match="more than 0"):
+        PreallocatedStack(maxDepth=0).append(1)
+    with pytest.raises(ValueError):
+        PreallocatedStack(maxDepth=-1)
+
+#========== Output: ========================================
+import io
+import pytest
+
+def output(v):
+    out = io.BytesIO()
+    state = EngineState(out=out)
+    state.push(v)
+    run([(i_output, None)], state)
+    return out.getvalue()
+
+def test_output_integer():
+    assert output(120) == b"x"
+
+def test_output_nested_io_list():
+    a = makeArray
+    assert output(a([72, a([105, a([]), a([32, 0x2603])]), 33])) == "Hi ☃!".encode("utf-8")
+
+def test_output_large_flat_string():
+    assert output(makeArray([97] * 100000)) == b"a" * 100000
+
+def test_output_rejects_non_io_lists():
+    for v in [MARKER, makeArray([1, MARKER]), [1, 2], -1]:
+        with pytest.raises(ExecutionError):
+            output(v)
+
+def test_debug_dump_to_stderr(capsys):
+    out = io.BytesIO()
+    run([(i_pushInteger, 65), (i_dup, None), (i_output, None), (i_printDebugDump, None)],
+        EngineState(out=out))
+    assert out.getvalue() == b"A"
+    assert capsys.readouterr() == ("", "/---- DUMP:\nAddress: 3\nStack: [65]\n\\----\n")
+
+def test_output_example(capsys):
+    examples = os.path.join(os.path.dirname(__file__), "..", "..", "examples")
+    with open(os.path.join(examples, "print-x.dull")) as f:
+        run(compile(f.read()))
+    assert capsys.readouterr().out == "x"
+
+#========== Input: ========================================
+def inputs(data, *counts):
+    state = EngineState(out=io.BytesIO(), inp=io.BytesIO(data))
+    for count in counts:
+        state.push(count)
+        run([(i_input, None)], state)
+        state.ip = 0
+    return ["".join(map(chr, v)) for v in state.stack]
+
+def test_input_count():
+    assert inputs(b"abcdef", 2, 3, 5) == ["ab", "cde", "f"]
+
+def test_input_utf8():
+    assert inputs("☃x☃".encode("utf-8"), 1, 2) == ["☃", "x☃"]
+
+def test_input_line():
+    assert inputs(b"one\ntwo\nthree", 0, 1, 0, 0, 0) == ["one\n", "t", "wo\n", "three", ""]
+
+def test_input_non_blocking_on_stream():
+    assert inputs(b"abc", -2, -5) == ["ab", "c"]
+
+def test_input_non_blocking_on_pipe():
+    (r, w) = os.pipe()
+    with os.fdopen(r, "rb") as inp, os.fdopen(w, "wb") as wr:
+        state = EngineState(out=io.BytesIO(), inp=inp)
+        code = [(i_pushInteger, -10), (i_input, None)]
+        assert run(code, state).stack == [makeArray([])]
+        wr.write(b"hello")
+        wr.flush()
+        state.ip = 0
+        assert run(code, state).stack == [makeArray([]), makeArray(list(b"hello"))]
+        assert os.get_blocking(r)
+
+def test_input_flushes_output():
+    class Input(io.BytesIO):
+        def read(self, n):
+            events.append("read")
+            return io.BytesIO.read(self, n)
+    class Output(io.BytesIO):
+        def flush(self):
+            events.append("flush")
+    events = []
+    state = EngineState(out=Output(), inp=Input(b"x"))
+    run([(i_pushInteger, 1), (i_input, None)], state)
+    assert events[:2] == ["flush", "read"]
+
+def test_text_only_standard_streams(monkeypatch):
+    # E.g. under contextlib.redirect_stdout(io.StringIO()):
+    monkeypatch.setattr(sys, "stdout", io.StringIO())
+    monkeypatch.setattr(sys, "stdin", io.StringIO("h\u00e9llo\n"))
+    state = run([(i_pushInteger, 2), (i_input, None), (i_output, None),
+                 (i_pushInteger, 0x263A), (i_output, None)])
+    assert sys.stdout.getvalue() == "h\u00e9\u263a"
+
+def test_missing_standard_streams(monkeypatch):
+    monkeypatch.setattr(sys, "stdout", None)
+    monkeypatch.setattr(sys, "stdin", None)
+    state = run([(i_pushInteger, 3), (i_input, None), (i_dup, None), (i_output, None)])
+    assert state.stack == [makeArray([])]
+
+def test_standard_streams_looked_up_lazily(monkeypatch):
+    state = EngineState()
+    out = io.BytesIO()
+    monkeypatch.setattr(sys, "stdout", io.TextIOWrapper(out))
+    run([(i_pushInteger, ord("x")), (i_output, None)], state)
+    assert out.getvalue() == b"x"
+
+#========== Arrays: ========================================
+def execute(values, *instructions):
+    state = EngineState(out=io.BytesIO())
+    state.stack.extend(values)
+    return run([(ins, None) for ins in instructions], state).stack
+
+def test_create_array():
+    assert execute([1, MARKER, 2, 3], i_createArray) == [1, makeArray([2, 3])]
+    assert isinstance(execute([MARKER, 2, 3], i_createArray)[0].items, array)
+    big = execute([MARKER, 2**70], i_createArray)[0]
+    assert isinstance(big.items, list) and big.items == [2**70]
+
+def test_array_fetch_and_store():
+    a = makeArray([5, 6, 7])
+    assert execute([a, 1], i_arrayFetch) == [6]
+    assert execute([a, 2, 9], i_arrayStore) == []
+    assert a == makeArray([5, 6, 9])
+    for index in [3, -1, MARKER]:
+        with pytest.raises(ExecutionError):
+            execute([a, index], i_arrayFetch)
+    with pytest.raises(ExecutionError):
+        execute([7, 0], i_arrayFetch)
+
+def test_storing_references_promotes_in_place():
+    a = makeArray([1, 2])
+    b = makeArray([3])
+    execute([a, 0, b], i_arrayStore)
+    assert isinstance(a.items, list) and a.items[0] is b
+    assert execute([a, 0], i_arrayFetch) == [b]
+
+def test_array_size_and_resize():
+    a = makeArray([1, 2, 3])
+    assert execute([a], i_arrayGetSize) == [3]
+    execute([a, 5], i_arrayResize)
+    assert a == makeArray([1, 2, 3, 0, 0])
+    execute([a, 1], i_arrayResize)
+    assert a == makeArray([1])
+    b = makeArray([a])
+    execute([b, 3], i_arrayResize)
+    assert b == makeArray([a, 0, 0])
+    with pytest.raises(ExecutionError):
+        execute([a, -1], i_arrayResize)
+
+def test_array_range_copy():
+    src = makeArray(range(10))
+    dest = makeArray([0] * 5)
+    execute([src, 6, dest, 1, 4], i_arrayRangeCopy)
+    assert dest == makeArray([0, 6, 7, 8, 9])
+    assert isinstance(dest.items, array)
+    # Overlapping copy within one array:
+    execute([src, 0, src, 2, 5], i_arrayRangeCopy)
+    assert src == makeArray([0, 1, 0, 1, 2, 3, 4, 7, 8, 9])
+    # Copying references promotes the destination:
+    refs = makeArray([src, 1])
+    execute([refs, 0, dest, 3, 2], i_arrayRangeCopy)
+    assert dest == makeArray([0, 6, 7, src, 1])
+    for args in [[src, 9, dest, 0, 2], [src, 0, dest, 4, 2], [src, 0, dest, 0, -1]]:
+        with pytest.raises(ExecutionError):
+            execute(args, i_arrayRangeCopy)
+
+#========== Call and return: ========================================
+def test_call_and_return():
+    # 5 call(F) 9 1 branch(end); F: dup add return. The call returns past
+    # the 9, the rest of its line.
+    code = [(i_pushInteger, 5), (i_call, (5, 1, False)), (i_pushInteger, 9), (i_pushInteger, 1),
+            (i_branch, 8), (i_dup, None), (i_add, None), (i_return, None)]
+    assert assertEnginesAgree(code) == [10, 1]
+
+def test_call_pushes_return_address():
+    state = run([(i_pushInteger, 5), (i_call, (2, 0, False))])
+    assert state.stack == [ReturnAddress(2), 5]
+    # Every engine pushes the one ReturnAddress of each call site:
+    code = [(i_pushInteger, 5), (i_call, (1, 1, False))]
+    for (name, engine) in ENGINES.items():
+        state = EngineState(stack=PreallocatedStack(maxDepth=10))
+        with pytest.raises(ExecutionError):
+            engine(code, state)
+        assert state.stack[0] == ReturnAddress(3), name
+        assert all(state.stack[i] is state.stack[0] for i in range(9)), name
+
+def countdownProcedure(n):
+    # n call(F) branch(end); F: dup branchIfPositive(G) return; G: 1 swap sub call(F) return
+    return [(i_pushInteger, n), (i_call, (3, 0, False)), (i_branch, 11),
+            (i_dup, None), (i_branchIfPositive, 6), (i_return, None),
+            (i_pushInteger, 1), (i_swap, None), (i_sub, None), (i_call, (3, 0, True)), (i_return, None)]
+
+def test_tail_calls_run_in_constant_stack():
+    for (name, engine) in ENGINES.items():
+        state = EngineState(stack=PreallocatedStack(maxDepth=4))
+        assert engine(countdownProcedure(10000), state).stack == [0], name
+        assert state.stack.highWater == 3
+    # Otherwise, each call leaves a return address:
+    code = countdownProcedure(100)
+    code[9] = (i_call, (3, 0, False))
+    state = run(code, EngineState(stack=PreallocatedStack()))
+    assert (state.stack, state.stack.highWater) == ([0], 103)
+
+def test_return_requires_return_address():
+    for engine in ENGINES.values():
+        with pytest.raises(ExecutionError):
+            engine([(i_pushInteger, 5), (i_pushInteger, 6), (i_return, None)])
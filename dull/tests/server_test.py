@@ -0,0 +1,89 @@
+import io
+import json
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from dull.server import *
+
+PRINT_X = open(os.path.join(os.path.dirname(__file__), "..", "..", "examples", "print-x.dull")).read()
+REFERENCE = "All work and no play makes Jack a dull boy\n"
+# Repetitions of the reference inserting a letter before "boy", and ending
+# with a punctuation mark:
+def line(letter="", end=""): return "all work and no play makes jack a dull %sboy%s\n" % (letter, end)
+LOOP = REFERENCE + line("j", "!") + line("a", ",")
+
+@pytest.fixture
+def server():
+    s = Server(workers=2, cacheSize=2)
+    yield s
+    s.shutdown()
+
+def test_job_output_and_cache(server):
+    first = server.runJob({"id": 1, "source": PRINT_X})
+    assert (first["id"], first["stdout"], first["error"], first["cached"]) == (1, "x", None, False)
+    assert first["executed"] == 4 and first["timings"]["run"] >= 0
+    second = server.runJob({"id": 2, "source": PRINT_X})
+    assert (second["stdout"], second["cached"]) == ("x", True)
+    for engine in ["bytecode", "python", "closure"]:
+        assert server.runJob({"source": PRINT_X, "engine": engine})["stdout"] == "x"
+
+def test_cache_evicts_least_recently_used():
+    cache = ProgramCache(2)
+    (a, b, c) = (REFERENCE + line("a"), REFERENCE + line("g"), REFERENCE + line("c"))
+    for source in [a, b, a, c, a, b]:
+        cache.get(source)
+    assert (cache.hits, cache.misses) == (2, 4)
+    assert list(cache.programs) == [(a, "tuple", False), (b, "tuple", False)]
+
+def test_job_errors(server):
+    assert server.runLine("{")["error"].startswith("Invalid job")
+    assert server.runJob({"id": 3})["error"] == "Invalid job: missing 'source'"
+    assert server.runJob({"source": "xy"})["error"].startswith("Exception: Syntax error")
+    result = server.runJob({"source": LOOP, "instructions": 100})
+    assert result["error"] == "ExecutionError: Budget exhausted after 100 instructions"
+    assert result["stdout"] == "\n" * 25
+    assert "tuple engine" in server.runJob({"source": LOOP, "seconds": 1, "engine": "python"})["error"]
+
+def test_default_budgets_only_for_tuple_engine():
+    budgeted = Server(2, instructions=100)
+    try:
+        assert "Budget exhausted" in budgeted.runJob({"source": LOOP})["error"]
+        result = budgeted.runJob({"source": REFERENCE + line("a", "!"), "engine": "bytecode"})
+        assert (result["stdout"], result["error"]) == ("\x01", None)
+    finally:
+        budgeted.shutdown()
+
+def test_job_stdin(server):
+    # Reads one character and outputs it:
+    echo = REFERENCE + line("a", "?") + line(end="!")
+    assert server.runJob({"source": echo, "stdin": "hello"})["stdout"] == "h"
+    assert server.runJob({"source": PRINT_X, "stdin": "ignored"})["stdout"] == "x"
+
+def test_serve_stream(server):
+    inp = io.StringIO("".join(json.dumps({"id": n, "source": PRINT_X}) + "\n" for n in range(5)) + "\n")
+    out = io.StringIO()
+    server.serveStream(inp, out)
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert sorted(r["id"] for r in results) == list(range(5))
+    assert all(r["stdout"] == "x" for r in results)
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs Unix sockets")
+def test_serve_socket(server, tmp_path):
+    path = str(tmp_path / "dull.sock")
+    thread = threading.Thread(target=server.serveSocket, args=(path,))
+    thread.start()
+    try:
+        while not os.path.exists(path): time.sleep(0.01)
+        with socket.socket(socket.AF_UNIX) as s:
+            s.connect(path)
+            s.sendall((json.dumps({"id": "a", "source": PRINT_X}) + "\n").encode("utf-8"))
+            s.shutdown(socket.SHUT_WR)
+            result = json.loads(s.makefile().readline())
+        assert (result["id"], result["stdout"]) == ("a", "x")
+    finally:
+        server.socketServer.shutdown()
+        thread.join()
@@ -0,0 +1,58 @@
+import io
+
+import pytest
+
+from dull.runtime import *
+from dull.tracer import TraceBuffer, debugInfoFor, main, readTrace, runTraced
+
+SRC = ("All work and no play makes Jack a dull boy\n"
+       "all work and no play makes jack a dull aboy!\n"
+       "all work and no play makes jack a dullboy!\n")
+
+def test_ring_keeps_last_instructions():
+    # 3; L: 1 swap sub dup branchIfPositive(L)
+    code = [(i_pushInteger, 3), (i_pushInteger, 1), (i_swap, None),
+            (i_sub, None), (i_dup, None), (i_branchIfPositive, 1)]
+    trace = TraceBuffer(4)
+    runTraced(code, trace)
+    assert trace.recorded == 16
+    assert trace.records() == [(2, "swap", 2, "1"), (3, "sub", 2, "1"),
+                               (4, "dup", 1, "0"), (5, "branchIfPositive", 2, "0")]
+    trace = TraceBuffer(100)
+    runTraced(code, trace)
+    assert [r[0] for r in trace.records()] == [0] + [1, 2, 3, 4, 5] * 3
+
+def test_top_of_stack_kinds():
+    code = [(i_pushMarker, None), (i_pushConstantArray, (1, 2)), (i_pushInteger, 2**70),
+            (i_pushInteger, 5), (i_call, (5, 0, False)), (i_pop, None)]
+    trace = TraceBuffer()
+    runTraced(code, trace, EngineState(out=io.BytesIO()))
+    assert [r[3] for r in trace.records()] == [
+        "-", "<marker>", "<array of 2>", "<71-bit positive integer>", "5", "5"]
+
+def test_failing_instruction_recorded_last():
+    trace = TraceBuffer()
+    with pytest.raises(ExecutionError):
+        runTraced([(i_pushMarker, None), (i_output, None), (i_pushInteger, 1)], trace,
+                  EngineState(out=io.BytesIO()))
+    assert trace.records()[-1] == (1, "output", 1, "<marker>")
+
+def test_trace_file_decoded_against_source(tmp_path, capsys):
+    src = tmp_path / "prog.dull"
+    src.write_text(SRC)
+    info = debugInfoFor(str(src), False)
+    code = [(i_pushInteger, 1), (i_output, None), (i_createArray, None)]
+    trace = TraceBuffer()
+    with pytest.raises(IndexError):
+        runTraced(code, trace, EngineState(out=io.BytesIO()))
+    path = tmp_path / "prog.trace"
+    with open(path, "wb") as f:
+        trace.write(f, str(src))
+    with open(path, "rb") as f:
+        (decoded, srcfile, optimized) = readTrace(f)
+    assert (decoded.records(), srcfile, optimized) == (trace.records(), str(src), False)
+    assert main([str(path)]) == 0
+    report = capsys.readouterr().out
+    assert report == trace.report(info)
+    assert report.splitlines()[-1].split() == ["3", "%s:3" % (src,), "[All]", "@2",
+                                               "createArray", "0", "-"]
@@ -0,0 +1,58 @@
+import pytest
+
+from dull.runtime import *
+from dull.verifier import *
+
+def countdownLoop(n):
+    # n; L: 1 swap sub dup branchIfPositive(L)
+    return [(i_pushInteger, n), (i_pushInteger, 1), (i_swap, None),
+            (i_sub, None), (i_dup, None), (i_branchIfPositive, 1),
+            (i_branch, 8), (i_pushInteger, 99)]
+
+def test_loop_depths_known():
+    analysis = verify(countdownLoop(3))
+    assert analysis.blocks == [0, 1, 6, 7]
+    assert analysis.entryDepths == {0: (0, 0), 1: (1, 1), 6: (1, 1)}  # 7 is unreachable
+    assert analysis.underflows == []
+
+def test_labels_start_blocks():
+    code = [(i_pushInteger, 1), (i_pushInteger, 2), (i_add, None)]
+    assert verify(code, {"a": [1]}).blocks == [0, 1]
+
+def test_certain_underflow_rejected():
+    with pytest.raises(VerificationError, match="address 2: add needs 2 values, the stack holds 1"):
+        verify([(i_pushInteger, 1), (i_branch, 2), (i_add, None)])
+
+def test_conditional_underflow_recorded():
+    code = [(i_pushInteger, 1), (i_branchIfPositive, 3), (i_pop, None), (i_pushInteger, 2)]
+    analysis = verify(code)
+    assert analysis.underflows == [(2, 1, (0, 0))]
+
+def test_underflow_on_every_path_rejected():
+    # Both ways out of the branch lead to the pops:
+    code = [(i_pushInteger, 1), (i_branchIfPositive, 2), (i_pop, None), (i_pop, None)]
+    with pytest.raises(VerificationError, match="address 2: pop needs 1 values, the stack holds 0"):
+        verify(code)
+    # A loop avoiding the underflow may run forever:
+    code = [(i_pushInteger, 1), (i_branchIfPositive, 0), (i_pop, None)]
+    assert verify(code).underflows == [(2, 1, (0, 0))]
+
+def test_growing_loop_converges():
+    code = [(i_pushInteger, 1), (i_dup, None), (i_branchIfPositive, 0)]
+    analysis = verify(code)
+    assert analysis.entryDepths[0] == (0, None)
+    # Popping loops keep a lower bound of what they need:
+    code = [(i_pop, None), (i_pushInteger, 1), (i_branchIfPositive, 0)]
+    analysis = analyze(code)
+    assert analysis.underflows == [(0, 1, (0, 0))]
+
+def test_call_and_return():
+    code = [(i_pushInteger, 5), (i_pushInteger, 7), (i_call, (4, 0, False)), (i_branch, 5),
+            (i_return, None)]
+    analysis = verify(code)
+    assert (analysis.entryDepths[3], analysis.entryDepths[4]) == ((2, 2), (3, 3))
+    assert analysis.underflows == []
+
+def test_create_array_depth_bounded():
+    code = [(i_pushMarker, None), (i_pushInteger, 1), (i_createArray, None), (i_output, None)]
+    assert verify(code).underflows == []
@@ -0,0 +1,197 @@
+"""Execution trace: the last instructions executed, for diagnosing a
+failing run after the fact.
+
+runTraced() executes code like runtime.run(), recording for each
+instruction, before it is executed, its address, its instruction, the
+stack depth and the value on the top of the stack. Records are kept in a
+TraceBuffer, a ring of integers allocated up front, so tracing a long run
+costs no more memory than a short one, and recording allocates nothing.
+The plain engines are untouched, so tracing costs nothing unless it is
+used.
+
+A trace is written in a binary form (TraceBuffer.write()), which this
+module decodes, mapping addresses back to source lines by re-assembling
+the source:
+
+Usage: python -m dull.tracer [options] TRACEFILE
+"""
+from array import array
+import argparse
+import marshal
+import sys
+
+from dull.lexer import iterNumberedTokens
+from dull.assembler import assembleWithLines
+from dull.optimizer import optimize
+from dull.profiler import DebugInfo
+import dull.runtime
+from dull.runtime import *
+
+TRACE_FORMAT = 1
+DEFAULT_TRACE_ENTRIES = 4096
+
+# Each record is ENTRY_SIZE integers: (ip, opcode | top kind, depth, top).
+ENTRY_SIZE = 4
+
+# Instructions are recorded by their index in the runtime; a trace file
+# carries their names, so it can be decoded by another version.
+INSTRUCTIONS = [f for (name, f) in vars(dull.runtime).items()
+                if name.startswith("i_") and callable(f)]
+OPCODES = dict((f, n) for (n, f) in enumerate(INSTRUCTIONS))
+UNKNOWN_OPCODE = len(INSTRUCTIONS)
+INSTRUCTION_NAMES = [f.__name__[2:] for f in INSTRUCTIONS] + ["?"]
+
+# The kind of value on the top of the stack, stored above the opcode, and
+# what the top field holds for it:
+KIND_SHIFT = 16
+OPCODE_MASK = (1 << KIND_SHIFT) - 1
+TOP_INTEGER = 0 << KIND_SHIFT        # The integer
+TOP_EMPTY = 1 << KIND_SHIFT          # Nothing: the stack is empty
+TOP_MARKER = 2 << KIND_SHIFT         # Nothing
+TOP_ARRAY = 3 << KIND_SHIFT          # The array's size
+TOP_RETURN = 4 << KIND_SHIFT         # The return address
+TOP_LARGE_INTEGER = 5 << KIND_SHIFT  # The integer's bit length, signed
+TOP_OTHER = 6 << KIND_SHIFT          # Nothing
+
+INTEGER_MIN = -2**63
+INTEGER_MAX = 2**63 - 1
+
+def classifyTop(v):
+    """(kind, top field) for a value not stored as a plain integer."""
+    if v is MARKER: return (TOP_MARKER, 0)
+    if isinstance(v, DullArray): return (TOP_ARRAY, len(v.items))
+    if isinstance(v, ReturnAddress): return (TOP_RETURN, v.addr)
+    if isinstance(v, int): return (TOP_LARGE_INTEGER, v.bit_length() if v > 0 else -v.bit_length())
+    return (TOP_OTHER, 0)
+
+def describeTop(kind, top):
+    if kind == TOP_INTEGER: return str(top)
+    if kind == TOP_EMPTY: return "-"
+    if kind == TOP_MARKER: return "<marker>"
+    if kind == TOP_ARRAY: return "<array of %d>" % (top,)
+    if kind == TOP_RETURN: return "<return to %d>" % (top,)
+    if kind == TOP_LARGE_INTEGER: return "<%d-bit %s integer>" % (abs(top), "negative" if top < 0 else "positive")
+    return "<other>"
+
+class TraceBuffer:
+    """The records of the last `capacity` instructions executed."""
+    def __init__(self, capacity=DEFAULT_TRACE_ENTRIES):
+        self.entries = array("q", bytes(8 * ENTRY_SIZE * max(capacity, 1)))
+        self.next = 0       # Index in `entries` of the next record
+        self.recorded = 0   # Records ever written, including overwritten ones
+        self.names = INSTRUCTION_NAMES
+
+    def capacity(self): return len(self.entries) // ENTRY_SIZE
+
+    def records(self):
+        """The records kept, oldest first, as (ip, instruction name, depth,
+        top description) tuples."""
+        e = self.entries
+        if self.recorded >= self.capacity():
+            e = e[self.next:] + e[:self.next]
+        else:
+            e = e[:self.next]
+        records = []
+        for i in range(0, len(e), ENTRY_SIZE):
+            (ip, op, depth, top) = e[i:i+ENTRY_SIZE]
+            name = self.names[min(op & OPCODE_MASK, len(self.names) - 1)]
+            records.append((ip, name, depth, describeTop(op & ~OPCODE_MASK, top)))
+        return records
+
+    def report(self, debugInfo=None):
+        """The records kept, one per line, numbered in execution order."""
+        records = self.records()
+        first = self.recorded - len(records)
+        out = ["Trace of the last %d of %d instructions:" % (len(records), self.recorded)]
+        out.append("%10s  %-32s %-18s %6s  %s" % ("#", "address", "instruction", "depth", "top"))
+        for (n, (ip, name, depth, top)) in enumerate(records, first + 1):
+            where = debugInfo.describe(ip) if debugInfo != None else "@%d" % (ip,)
+            out.append("%10d  %-32s %-18s %6d  %s" % (n, where, name, depth, top))
+        return "\n".join(out) + "\n"
+
+    def write(self, f, srcfile=None, optimized=False):
+        """Write the trace to the binary file `f`, noting the source it
+        was assembled from, for decoding."""
+        marshal.dump((TRACE_FORMAT, srcfile, optimized, self.names, self.recorded,
+                      self.next, sys.byteorder, self.entries.tobytes()), f)
+
+def readTrace(f):
+    """Read a trace written by TraceBuffer.write(). Returns (trace,
+    source file, whether the code was optimized)."""
+    data = marshal.load(f)
+    if not isinstance(data, tuple) or data[0] != TRACE_FORMAT:
+        raise ValueError("Not a trace file, or a trace of another format")
+    (fmt, srcfile, optimized, names, recorded, nextIndex, byteorder, entries) = data
+    trace = TraceBuffer(0)
+    trace.entries = array("q")
+    trace.entries.frombytes(entries)
+    if byteorder != sys.byteorder: trace.entries.byteswap()
+    (trace.names, trace.recorded, trace.next) = (list(names), recorded, nextIndex)
+    return (trace, srcfile, optimized)
+
+def runTraced(code, trace, state=None):
+    if state == None: state = EngineState()
+    stack = state.stack
+    ops = [OPCODES.get(fun, UNKNOWN_OPCODE) for (fun, arg) in code]
+    entries = trace.entries
+    size = len(entries)
+    i = trace.next
+    n = 0
+    try:
+        while True:
+            ip = state.ip
+            if ip >= len(code): break
+            entries[i] = ip
+            depth = len(stack)
+            entries[i+2] = depth
+            if depth == 0:
+                entries[i+1] = ops[ip] | TOP_EMPTY
+                entries[i+3] = 0
+            else:
+                top = stack[-1]
+                if top.__class__ is int and INTEGER_MIN <= top <= INTEGER_MAX:
+                    entries[i+1] = ops[ip]
+                    entries[i+3] = top
+                else:
+                    (kind, top) = classifyTop(top)
+                    entries[i+1] = ops[ip] | kind
+                    entries[i+3] = top
+            i += ENTRY_SIZE
+            if i == size: i = 0
+            n += 1
+            state.ip = ip + 1
+            (fun,arg) = code[ip]
+            fun(state, arg)
+    finally:
+        trace.next = i
+        trace.recorded += n
+        state.flush()
+    return state
+
+#==================== Decoder ====================
+def debugInfoFor(srcfile, optimized):
+    with open(srcfile, "r") as f:
+        (code, labelMap, lineMap) = assembleWithLines(iterNumberedTokens(f))
+    if optimized:
+        code = optimize(code, labelMap, lineMap)
+    return DebugInfo(srcfile, labelMap, lineMap)
+
+def main(args):
+    parser = argparse.ArgumentParser(prog="python -m dull.tracer")
+    parser.add_argument("tracefile")
+    parser.add_argument("--source", metavar="PATH",
+                        help="the traced program's source (default: the path recorded in the trace)")
+    parser.add_argument("--no-source", action="store_true",
+                        help="show addresses only, without reading the source")
+    args = parser.parse_args(args)
+    with open(args.tracefile, "rb") as f:
+        (trace, srcfile, optimized) = readTrace(f)
+    srcfile = args.source or srcfile
+    debugInfo = None
+    if srcfile != None and not args.no_source:
+        debugInfo = debugInfoFor(srcfile, optimized)
+    sys.stdout.write(trace.report(debugInfo))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,206 @@
+"""Static stack-effect analysis of assembled code.
+
+analyze() splits the code into basic blocks (starting at the program
+start, at labelled addresses, branch destinations and return addresses,
+and after every branch, call or return) and computes, for each block reachable
+from the start, bounds on the stack depth on entry, the least depth before
+each instruction, and the instructions which underflow whenever they are
+reached.
+
+verify() rejects programs which underflow on every execution: those in
+which every path from the start reaches an instruction that underflows
+whenever it is reached.
+"""
+from bisect import bisect_right
+
+from dull.runtime import *
+
+class VerificationError(Exception):
+    def __init__(self, msg): Exception.__init__(self, msg)
+
+# (values popped, values pushed) by each instruction:
+STACK_EFFECTS = {
+    i_dup: (1, 2),
+    i_pop: (1, 0),
+    i_swap: (2, 2),
+    i_pushInteger: (0, 1),
+    i_pushMarker: (0, 1),
+    i_pushConstantArray: (0, 1),
+    i_add: (2, 1),
+    i_sub: (2, 1),
+    i_mul: (2, 1),
+    i_input: (1, 1),
+    i_output: (1, 0),
+    i_branch: (0, 0),
+    i_branchIfPositive: (1, 0),
+    i_call: (1, 2),
+    i_return: (2, 1),
+    i_arrayFetch: (2, 1),
+    i_arrayStore: (3, 0),
+    i_arrayGetSize: (1, 1),
+    i_arrayResize: (2, 0),
+    i_arrayRangeCopy: (5, 0),
+}
+# createArray pops down to the nearest marker, so only its minimal effect
+# is known: it needs one value (the marker), and leaves one (the array).
+# Instructions not listed leave the stack alone.
+CREATE_ARRAY_EFFECT = (1, 1)
+
+# Instructions whose argument is a code address:
+ADDRESS_INSTRUCTIONS = (i_branch, i_branchIfPositive, i_call)
+
+# Instructions after which execution does not fall through:
+BLOCK_ENDS = (i_branch, i_branchIfPositive, i_call, i_return)
+
+# Entry depth updates of a block after which its upper bound is dropped,
+# so that loops which grow the stack converge:
+WIDENING_UPDATES = 3
+
+def stackEffect(fun, arg=None):
+    if fun == i_createArray: return CREATE_ARRAY_EFFECT
+    if fun == i_call and arg[2]: return (0, 0)  # A tail call
+    return STACK_EFFECTS.get(fun, (0, 0))
+
+class StackAnalysis:
+    """Results of analyze(). Depth bounds are (low, high) pairs, high being
+    None when unbounded."""
+    def __init__(self, blocks):
+        self.blocks = blocks        # Block start addresses, in order
+        self.entryDepths = dict()   # Reachable block start -> depth bounds
+        # The least stack depth before each instruction, on any path
+        # reaching it; None for unreachable instructions:
+        self.lowDepths = []
+        # (address, values needed, depth bounds) of instructions which
+        # underflow whenever they are reached:
+        self.underflows = []
+
+def branchTargets(code, labelMap):
+    targets = set()
+    for addrs in labelMap.values():
+        targets.update(addrs)
+    for ip in range(len(code)):
+        (fun, arg) = code[ip]
+        if fun == i_call:
+            targets.add(arg[0])
+            targets.add(returnSite(ip, arg))
+        elif fun in ADDRESS_INSTRUCTIONS:
+            targets.add(arg)
+    return targets
+
+def returnSites(code):
+    """The return addresses of the calls which are not tail calls."""
+    return [returnSite(ip, code[ip][1]) for ip in range(len(code))
+            if code[ip][0] == i_call and not code[ip][1][2]]
+
+def blockStarts(code, labelMap=None):
+    starts = branchTargets(code, labelMap or dict())
+    starts.add(0)
+    for ip in range(len(code)):
+        if code[ip][0] in BLOCK_ENDS: starts.add(ip + 1)
+    return sorted(s for s in starts if s < len(code))
+
+def analyze(code, labelMap=None):
+    blocks = blockStarts(code, labelMap)
+    analysis = StackAnalysis(blocks)
+    if not code: return analysis
+    ends = dict(zip(blocks, blocks[1:] + [len(code)]))
+    sites = returnSites(code)
+    updates = dict()
+    entry = analysis.entryDepths
+    entry[0] = (0, 0)
+    pending = [0]
+    while pending:
+        start = pending.pop()
+        (depth, successors) = analyzeBlock(code, start, ends[start], entry[start],
+                                           sites, analysis)
+        for s in successors:
+            if s >= len(code): continue
+            old = entry.get(s)
+            new = depth if old == None else mergeDepths(old, depth)
+            if new == old: continue
+            updates[s] = updates.get(s, 0) + 1
+            if updates[s] > WIDENING_UPDATES: new = (new[0], None)
+            entry[s] = new
+            if s not in pending: pending.append(s)
+    analysis.lowDepths = [None] * len(code)
+    for (start, depth) in entry.items():
+        analyzeBlock(code, start, ends[start], depth, sites, analysis, analysis.lowDepths)
+    analysis.underflows = sorted(set(analysis.underflows))
+    return analysis
+
+def mergeDepths(a, b):
+    high = None if a[1] == None or b[1] == None else max(a[1], b[1])
+    return (min(a[0], b[0]), high)
+
+def analyzeBlock(code, start, end, depth, returnSites, analysis, lowDepths=None):
+    """Apply the stack effects of the block [start; end[ to the entry
+    depth bounds, recording the least depth before each instruction in
+    `lowDepths`, if given. Returns (exit depth bounds, successor
+    addresses)."""
+    (low, high) = depth
+    for ip in range(start, end):
+        if lowDepths != None: lowDepths[ip] = low
+        (fun, arg) = code[ip]
+        (pops, pushes) = stackEffect(fun, arg)
+        if low < pops:
+            if high != None and high < pops:
+                analysis.underflows.append((ip, pops, (low, high)))
+                return ((low, high), [])
+            low = pops      # Execution only continues if there were enough.
+        low += pushes - pops
+        if high != None: high += pushes - pops
+        if fun == i_createArray: low = 1
+    return ((low, high), blockSuccessors(code, end, returnSites))
+
+def blockSuccessors(code, end, returnSites):
+    """The addresses execution may continue at after the block ending
+    before `end`."""
+    (fun, arg) = code[end - 1]
+    if fun == i_branch: return [arg]
+    if fun == i_branchIfPositive: return [arg, end]
+    if fun == i_call: return [arg[0]]
+    if fun == i_return: return returnSites
+    return [end]
+
+def unavoidable(code, analysis, failing):
+    """Does every path from the start reach one of the blocks `failing`?
+    A path escapes if it reaches the end of the code or runs into a loop
+    which none of them is on."""
+    blocks = analysis.blocks
+    ends = dict(zip(blocks, blocks[1:] + [len(code)]))
+    sites = returnSites(code)
+    (ACTIVE, DONE) = (1, 2)
+    marks = dict()
+    pending = [(0, iter([0]))]  # Depth-first: (block, successors left)
+    while pending:
+        (start, successors) = pending[-1]
+        s = next(successors, None)
+        if s == None:
+            marks[start] = DONE
+            pending.pop()
+        elif s >= len(code):
+            return False
+        elif s in failing or marks.get(s) == DONE:
+            continue
+        elif marks.get(s) == ACTIVE:
+            return False
+        else:
+            marks[s] = ACTIVE
+            pending.append((s, iter(blockSuccessors(code, ends[s], sites))))
+    return True
+
+def verify(code, labelMap=None):
+    """Analyze `code`, raising VerificationError if it underflows on every
+    execution. Returns the StackAnalysis."""
+    analysis = analyze(code, labelMap)
+    if not analysis.underflows: return analysis
+    starts = analysis.blocks
+    failing = dict()    # Block start -> its underflow
+    for (ip, pops, depth) in analysis.underflows:
+        failing.setdefault(starts[bisect_right(starts, ip) - 1], (ip, pops, depth))
+    if unavoidable(code, analysis, failing):
+        (ip, pops, (low, high)) = min(failing.values())
+        holds = "%d" % (low,) if low == high else "at most %d" % (high,)
+        raise VerificationError("Stack underflow at address %d: %s needs %d values, "
+                                "the stack holds %s" % (ip, code[ip][0].__name__[2:], pops, holds))
+    return analysis